@@ -9,6 +9,7 @@ import time
 import winsound  # pylint: disable=import-error
 import SimConnect  # pylint: disable=import-error
 import psx  # pylint: disable=unused-import
+from psx_codec import PsxRecord
 
 
 class ComparatorException(Exception):
@@ -157,15 +158,14 @@ class Comparator():  # pylint: disable=too-many-instance-attributes
                 continue
             # self.logger.debug("Getting data from PSX")
             try:
-                data = self.psx.get("PiBaHeAlTas")
-                # self.logger.debug("data=%s", data)
-                (pitch, bank, heading, altitude, _, latitude, longitude) = data.split(';')
-                pitch_r = float(pitch) / 100000
-                bank_r = float(bank) / 100000
-                heading_true_r = float(heading)
-                altitude_true_ft = float(altitude) / 1000
-                latitude_r = float(latitude)
-                longitude_r = float(longitude)
+                data = PsxRecord("PiBaHeAlTas", self.psx.get("PiBaHeAlTas"))
+                # self.logger.debug("data=%s", data.raw)
+                pitch_r = data['pitch'] / 100000
+                bank_r = data['bank'] / 100000
+                heading_true_r = data['heading']
+                altitude_true_ft = data['altitude'] / 1000
+                latitude_r = data['latitude']
+                longitude_r = data['longitude']
                 groundspeed_kt = float(self.psx.get("GroundSpeed"))
                 self.logger.debug("PSX pitch=%.2f bank=%.2f",
                                   math.degrees(pitch_r),
@@ -1,17 +1,57 @@
 """Replace PSX USB subsystem."""
-# pylint: disable=invalid-name
+# pylint: disable=invalid-name,too-many-lines
 import argparse
 import asyncio
+import heapq
 import importlib
 import logging
+import os
+import re
+import signal
+import threading
 import time
 from collections import defaultdict
 import pygame  # pylint: disable=import-error
 import psx  # pylint: disable=unused-import
+from frankenusb_config import compile_config, lut_index, FrankenUsbConfigException
+from frankenusb_curves import CalibrationLearner
+from frankenusb_logging import RateLimitedLogger, start_queue_logging
+from frankenusb_sound import SoundCues
+from frankenusb_stats import LatencyStats
+from frankenusb_replay import EventRecorder, EventReplayer, FrankenUsbReplayException
+from frankenusb_shm import InputProcess, FrankenUsbShmException
+from psx_codec import PsxRecord, PsxVector, PsxCodecException
 
 # The type of message we use to display the tiller status in the sim
 TILLER_MSG = "FreeMsgM"
 
+# While a filtered axis lags behind the last raw value, feed the raw
+# value again this often (s) until the filters catch up
+FILTER_SETTLE_INTERVAL = 0.02
+# Caught up means within one SDL axis step
+FILTER_SETTLE_EPSILON = 1.0 / 32767
+
+# A PSX variable Q code, e.g Qs123
+PSX_Q_CODE = re.compile(r"^Q[a-z][0-9]+$")
+
+# Read to wire latency over all axes and over all buttons
+WIRE_LATENCY_AXES = ('read to wire', 'all axes')
+WIRE_LATENCY_BUTTONS = ('read to wire', 'all buttons')
+
+# With --input-backend poll, look for pygame events this often (s).
+# Everything waiting is handled as one batch, so this only adds latency.
+POLL_INTERVAL = 0.005
+
+# Log messages from the code that runs for every axis event at most this often (s)
+HOT_LOG_INTERVAL = 1.0
+
+# With --calibrate, write what we have learned this often (s)
+CALIBRATION_WRITE_INTERVAL = 5.0
+
+# With --adaptive-rate-buffer, a variable is never sent less often
+# than its max rate divided by this
+MAX_RATE_BACKOFF = 8
+
 
 class FrankenUsbException(Exception):
     """FrankenUSB exception.
@@ -21,6 +61,44 @@ class FrankenUsbException(Exception):
     """
 
 
+class PsxStateCache():
+    """Parsed copies of the PSX variables we need on every axis event.
+
+    Filled in from PSX subscription callbacks and from our own
+    writes, so the hot path can read plain ints instead of splitting
+    PSX strings. Tla changes all the time while the autothrottle moves
+    the levers, so it is only parsed when we look at it.
+    """
+
+    __slots__ = ('afds', 'at_mode', 'at_active', 'tla_record')
+
+    def __init__(self):
+        """Initialize the cache with safe defaults."""
+        self.afds = PsxRecord('Afds', '0')
+        # Autothrottle mode (first element of Afds)
+        self.at_mode = 0
+        # True if the autothrottle is managing the levers
+        self.at_active = False
+        self.tla_record = PsxRecord('Tla', '0;0;0;0')
+
+    def set_afds(self, value):
+        """Update from a new Afds value.
+
+        If the AFDS mode is blank or HOLD, we own the levers :)
+
+        BLANK = 0
+        HOLD = 21
+        Source: https://aerowinx.com/board/index.php/topic,4408.msg72250.html#msg72250
+        """
+        self.afds.update(value)
+        self.at_mode = self.afds['at mode']
+        self.at_active = self.at_mode not in [0, 21]
+
+    def set_tla(self, value):
+        """Update from a new Tla value."""
+        self.tla_record.update(value)
+
+
 class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-public-methods
     """Replaces the PSX USB subsystem."""
 
@@ -33,25 +111,74 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
             datefmt="%H:%M:%S",
         )
         self.logger = logging.getLogger("frankenusb")
+        # For log messages in the per-event code
+        self.hot_log = RateLimitedLogger(self.logger, HOT_LOG_INTERVAL)
+        # Set by run(), writes our log messages from its own thread
+        self.log_listener = None
         self.config = None
+        self.config_misc = {}
+        # Joystick name -> axis -> calibration profile, from the calibration file
+        self.calibration = {}
+        # Set with --calibrate
+        self.calibration_learner = None
+        # The config compiled into one object per axis and button, by joystick name
+        self.compiled_config = {}
+        # (instance_id, axis) -> CompiledAxis
+        self.axis_dispatch = {}
+        # (instance_id, button, pygame event type) -> CompiledButton
+        self.button_dispatch = {}
+        # (instance_id, axis) -> FilterChain, for axes with filters
+        self.axis_filters = {}
+        # (instance_id, axis) -> asyncio.TimerHandle, see settle_axis_filters()
+        self.filter_settle_handles = {}
+        # (instance_id, axis) -> the newest raw value of a filtered axis
+        self.filter_raw_values = {}
+        # (instance_id, axis) -> index of the static zone the axis is in, for
+        # axes with static zone hysteresis
+        self.axis_zones = {}
+        # (instance_id, axis) -> t_read of the newest event queued for the axis
+        self.axis_latest_read = {}
         # Pygame events we are intersted in are added to this queue
         self.axis_event_queue = asyncio.Queue(maxsize=0)
         # Variables to be sent to PSX are added to this queue
         self.psx_axis_queue = asyncio.Queue(maxsize=0)
         self.joysticks = {}
+        # joystick name -> joystick (the first one opened, if several have the same name)
+        self.joysticks_by_name = {}
+        # instance_id -> joystick name, as the device may be gone when we close it
+        self.joystick_names = {}
         self.args = {}
         # Keeps track of what and when we have sent to PSX
         self.psx_send_state = defaultdict(dict)
+        # Heap of (time, variable) for variables waiting to be sent to PSX
+        self.psx_send_heap = []
+        # variable -> PsxVector with the fields of the variables we send field by field
+        self.psx_vectors = {}
+        # variable -> Q code, see psx_wire_key()
+        self.psx_wire_keys = {}
         # Main PSX connection object
         self.psx = None
         self.psx_connected = False
+        # Parsed PSX variables used in the hot path
+        self.psx_state = PsxStateCache()
+        self.psx_state_setters = {
+            'Afds': self.psx_state.set_afds,
+            'Tla': self.psx_state.set_tla,
+        }
         self.axis_cache = defaultdict(dict)
         self.aileron_tiller_active = False
+        self.sound_cues = SoundCues(self.logger)
+        # Input to wire latency histograms and event counters
+        self.stats = LatencyStats()
+        # Set if we record pygame events to a file or replay them from one
+        self.recorder = None
+        self.replayer = None
+        self.input_process = None
         # We use a button to toggle between reverse and normal mode for the throttles
         self.axis_reverse_mode = {}
 
-    def _handle_args(self):
-        """Handle command line arguments."""
+    def _handle_args(self, argv=None):
+        """Handle command line arguments (sys.argv unless argv is given)."""
         parser = argparse.ArgumentParser(
             prog='frankenusb',
             description='(partial)Replacement for PSX USB controller subsystem',
@@ -62,9 +189,61 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
                             action='store_true')
         parser.add_argument('--quiet',
                             action='store_true')
+        parser.add_argument('--psx-host',
+                            action='store',
+                            help='the PSX main server to connect to (default: psx.py default)',
+                            )
+        parser.add_argument('--psx-port',
+                            action='store', type=int,
+                            help='the PSX main server port (default: psx.py default)',
+                            )
+        parser.add_argument('--calibration-file',
+                            action='store', default="frankenusb-calibration.conf",
+                            help='axis calibration profiles, used if the file exists',
+                            )
+        parser.add_argument('--calibrate',
+                            action='store_true',
+                            help='learn axis calibration and write it to the calibration file',
+                            )
+        parser.add_argument('--input-backend',
+                            action='store', default='process', choices=['process', 'poll'],
+                            help='read pygame events in a separate input process as they '
+                            'arrive, or by polling every few ms',
+                            )
+        parser.add_argument('--event-batch-size',
+                            action='store', default=64, type=int,
+                            help='the maximum number of pygame events handled before yielding',
+                            )
+        parser.add_argument('--stats-interval',
+                            action='store', default=0.0, type=float,
+                            help='log latency statistics every N seconds (0 = never)',
+                            )
+        parser.add_argument('--record',
+                            action='store', metavar='FILE',
+                            help='record all joystick events to FILE',
+                            )
+        parser.add_argument('--replay',
+                            action='store', metavar='FILE',
+                            help='replay joystick events from FILE instead of using pygame',
+                            )
+        parser.add_argument('--replay-speed',
+                            action='store', default=1.0, type=float,
+                            help='replay speed relative to real time (0 = as fast as possible)',
+                            )
         parser.add_argument('--max-rate',
                             action='store', default=20.0, type=float,
-                            help='the maximum rate we update a PSX variable (Hz)',
+                            help='the maximum rate we update a PSX variable (Hz), '
+                            'unless set per variable in PSX_MAX_RATES in the config file',
+                            )
+        parser.add_argument('--adaptive-rate-buffer',
+                            action='store', default=0, type=int,
+                            help='slow down sending a variable while more than this many bytes '
+                            'are waiting to be sent to PSX (0 = never)',
+                            )
+        parser.add_argument('--max-event-age',
+                            action='store', default=50.0, type=float,
+                            help='drop axis events older than this (ms) if a newer event for '
+                            'the same axis is waiting (0 = never)',
                             )
         parser.add_argument('--axis-jitter-limit-low',
                             action='store', default=0.005, type=float,
@@ -75,7 +254,7 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
                             help='axis movements larger than this are filtered out',
                             )
 
-        self.args = parser.parse_args()
+        self.args = parser.parse_args(argv)
         self.logger.info("PSX max rate is set to %.1f Hz", self.args.max_rate)
         if self.args.quiet:
             self.logger.setLevel(logging.CRITICAL)
@@ -90,19 +269,109 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
         loader.exec_module(module)
         return module
 
+    def open_joystick(self, device_index):
+        """Open a configured joystick and add it to our indexes.
+
+        Returns the joystick, or None if it is not in the config.
+        """
+        joy = pygame.joystick.Joystick(device_index)
+        if joy.get_name() not in self.compiled_config:
+            self.logger.debug("Joystick %s (%s) but not configured", device_index, joy.get_name())
+            return None
+        return self.add_joystick(joy)
+
+    def add_joystick(self, joy):
+        """Add a configured joystick (or a stand-in for one) to our indexes."""
+        joystick_name = joy.get_name()
+        instance_id = joy.get_instance_id()
+        if instance_id in self.joysticks:
+            # Already open, e.g the JOYDEVICEADDED event SDL sends at startup
+            return self.joysticks[instance_id]
+        self.logger.info("Joystick %s found: %s", instance_id, joystick_name)
+        joy.init()
+        self.joysticks[instance_id] = joy
+        if joystick_name not in self.joysticks_by_name:
+            self.joysticks_by_name[joystick_name] = joy
+        self.joystick_names[instance_id] = joystick_name
+        self.add_dispatch(instance_id, self.compiled_config[joystick_name])
+        if self.calibration_learner is not None:
+            # Where the axes rest, pygame only tells us when they move
+            for axis in self.compiled_config[joystick_name].axes:
+                self.calibration_learner.record(joystick_name, axis, joy.get_axis(axis))
+        return joy
+
+    def close_joystick(self, instance_id):
+        """Close a joystick that has been removed and drop it from our indexes."""
+        joy = self.joysticks.pop(instance_id, None)
+        if joy is None:
+            # Not a joystick we were using
+            return
+        joystick_name = self.joystick_names.pop(instance_id)
+        self.logger.info("Joystick removed: %s", joystick_name)
+        self.remove_dispatch(instance_id)
+        self.axis_cache.pop(instance_id, None)
+        if self.joysticks_by_name.get(joystick_name) is joy:
+            del self.joysticks_by_name[joystick_name]
+            # Use another joystick with the same name, if we have one
+            for other in self.joysticks.values():
+                if other.get_name() == joystick_name:
+                    self.joysticks_by_name[joystick_name] = other
+                    break
+        joy.quit()
+
+    def handle_device_added(self, event):
+        """Open a joystick that was plugged in."""
+        self.open_joystick(event.device_index)
+
+    def handle_device_removed(self, event):
+        """Close a joystick that was unplugged."""
+        self.close_joystick(event.instance_id)
+
+    def add_dispatch(self, instance_id, device):
+        """Add the compiled axes and buttons of a joystick to the dispatch tables."""
+        for axis, axis_config in device.axes.items():
+            self.axis_dispatch[(instance_id, axis)] = axis_config
+            filters = axis_config.make_filters()
+            if filters is not None:
+                self.axis_filters[(instance_id, axis)] = filters
+        for (button, direction), button_config in device.buttons.items():
+            event_type = pygame.JOYBUTTONUP if direction == 'up' else pygame.JOYBUTTONDOWN
+            self.button_dispatch[(instance_id, button, event_type)] = button_config
+
+    def remove_dispatch(self, instance_id):
+        """Remove all axes and buttons of a joystick from the dispatch tables."""
+        for key in [key for key in self.axis_dispatch if key[0] == instance_id]:
+            del self.axis_dispatch[key]
+            self.axis_filters.pop(key, None)
+            self.filter_raw_values.pop(key, None)
+            self.axis_zones.pop(key, None)
+            self.axis_latest_read.pop(key, None)
+            handle = self.filter_settle_handles.pop(key, None)
+            if handle is not None:
+                handle.cancel()
+        for key in [key for key in self.button_dispatch if key[0] == instance_id]:
+            del self.button_dispatch[key]
+
+    def joystick_get_name(self, instance_id):
+        """Get the name of an open joystick, or '' if we don't have it open."""
+        joystick = self.joysticks.get(instance_id)
+        if joystick is None:
+            return ''
+        return joystick.get_name()
+
     def joystick_get_axis_position(self, joystick_name, axis):
         """Get the current position for a given axis."""
-        for _, joystick in self.joysticks.items():
-            if joystick.get_name() == joystick_name:
-                return joystick.get_axis(axis)
-        return False
+        joystick = self.joysticks_by_name.get(joystick_name)
+        if joystick is None:
+            return False
+        return joystick.get_axis(axis)
 
     def joystick_get_button_position(self, joystick_name, button):
         """Get the current position for a given button."""
-        for _, joystick in self.joysticks.items():
-            if joystick.get_name() == joystick_name:
-                return joystick.get_button(button)
-        return False
+        joystick = self.joysticks_by_name.get(joystick_name)
+        if joystick is None:
+            return False
+        return joystick.get_button(button)
 
     def centre_ailerons_and_tiller(self):
         """Send events to PSX that centres the aileron and tiller.
@@ -110,12 +379,12 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
         Used whenever we switch tiller mode on and off.
         """
         self.logger.info("centreing aileron and tiller")
-        self.psx_axis_queue.put({
+        self.psx_axis_queue.put_nowait({
             'variable': 'Tiller',
             'indexes': [0],
             'value': 0,
         })
-        self.psx_axis_queue.put({
+        self.psx_axis_queue.put_nowait({
             'variable': 'FltControls',
             'indexes': [1],
             'value': 0,
@@ -126,10 +395,9 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
 
         Towing is a string of six digits. Wee care about digits 4, 5 and 6, which are the heading.
         """
-        towing = str(self.psx.get('Towing'))
-        self.logger.debug("Towing string: %s", towing)
-        self.logger.debug("Current towing heading str: %s", towing[3:6])
-        heading = int(towing[3:6])
+        towing = PsxRecord('Towing', str(self.psx.get('Towing')))
+        self.logger.debug("Towing string: %s", towing.raw)
+        heading = towing['heading']
         self.logger.debug("Current towing heading: %s", heading)
         heading_new = heading + increment
         if heading_new > 360:
@@ -137,26 +405,26 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
         if heading_new < 0:
             heading_new += 360
         self.logger.debug("New towing heading: %s", heading_new)
-        towing_new = towing[:3] + str(heading_new).zfill(3)
-        self.logger.debug("New towing string: %s", towing_new)
-        self.psx_send_and_set('Towing', towing_new)
+        towing['heading'] = heading_new
+        self.logger.debug("New towing string: %s", towing.encode())
+        self.psx_send_and_set('Towing', towing.encode())
 
     def towing_direction_toggle(self):
         """Toggle the towing direction.
 
         Towing is a string of six digits. Wee care about digit 1 (1 = pushback, 2 = push forward)
         """
-        towing = str(self.psx.get('Towing'))
-        self.logger.debug("Towing string: %s", towing)
-        direction = towing[0]
+        towing = PsxRecord('Towing', str(self.psx.get('Towing')))
+        self.logger.debug("Towing string: %s", towing.raw)
+        direction = towing['direction']
         if direction == "1":
             direction = "2"
         else:
             direction = "1"
         self.logger.debug("New towing direction: %s", direction)
-        towing_new = direction + towing[1:]
-        self.logger.debug("New towing string: %s", towing_new)
-        self.psx_send_and_set('Towing', towing_new)
+        towing['direction'] = direction
+        self.logger.debug("New towing string: %s", towing.encode())
+        self.psx_send_and_set('Towing', towing.encode())
 
     def towing_mode_toggle(self):
         """Toggle the towing mode (start/stop).
@@ -164,61 +432,30 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
         Towing is a string of six digits. Wee care about digit 2 and 3 (20=stop, 80=start)
         We never use auto.
         """
-        towing = str(self.psx.get('Towing'))
-        self.logger.debug("Towing string: %s", towing)
-        mode = towing[1:3]
+        towing = PsxRecord('Towing', str(self.psx.get('Towing')))
+        self.logger.debug("Towing string: %s", towing.raw)
+        mode = towing['mode']
         self.logger.debug("Towing mode: %s", mode)
         if mode == "10":
             mode = "98"
         else:
             mode = "20"
         self.logger.debug("New towing mode: %s", mode)
-        towing_new = towing[:1] + mode + towing[3:]
-        self.logger.debug("New towing string: %s", towing_new)
-        self.psx_send_and_set('Towing', towing_new)
+        towing['mode'] = mode
+        self.logger.debug("New towing string: %s", towing.encode())
+        self.psx_send_and_set('Towing', towing.encode())
 
     async def handle_axis_motion_normal(self, event, axis_config):
         """Handle motion on a normal axis."""
-        # pygame axes are always -1 .. +1?
-        axis_min = -1.0
-        axis_max = 1.0
-        # Apply static zones to pygame axis value
-        if 'static zones' in axis_config:
-            for zone in axis_config['static zones']:
-                if event.value >= zone[0] and event.value <= zone[1]:
-                    self.logger.debug("In static zone: %s -> %s", event.value, zone[2])
-                    event.value = zone[2]
-        # Swap axis if neede
-        if 'axis swap' in axis_config:
-            if axis_config['axis swap'] is True:
-                event.value = -event.value
-        # Normalize
-        axis_normalized = (event.value - axis_min) / (axis_max - axis_min)
-
-        tiller_axis_in_tiller_mode = False
-        if 'tiller' in axis_config and axis_config['tiller'] is True and self.aileron_tiller_active:
-            tiller_axis_in_tiller_mode = True
-
-        if tiller_axis_in_tiller_mode:
+        if axis_config.tiller and self.aileron_tiller_active:
             # Tiller mode
-            psx_min = -999
-            psx_max = 999
-            psx_range = psx_max - psx_min
-            psx_value = int(psx_min + psx_range * axis_normalized)
-            await self.psx_axis_queue.put({
-                'variable': 'Tiller',
-                'indexes': [0],
-                'value': psx_value,
-            })
+            await self.queue_psx_axis(event, axis_config, 'Tiller', [0],
+                                      axis_config.tiller_table[lut_index(event.value)])
         else:
             # Normal mode
-            psx_range = axis_config['psx max'] - axis_config['psx min']
-            psx_value = int(axis_config['psx min'] + psx_range * axis_normalized)
-            await self.psx_axis_queue.put({
-                'variable': axis_config['psx variable'],
-                'indexes': axis_config['indexes'],
-                'value': psx_value,
-            })
+            await self.queue_psx_axis(event, axis_config, axis_config.psx_variable,
+                                      axis_config.indexes,
+                                      axis_config.table[lut_index(event.value)])
 
     async def handle_axis_motion_speedbrake(self, event, axis_config):
         """Handle motion on a speedbrake axis.
@@ -229,142 +466,131 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
         max in flight: 375
         full ground 800
         """
-        axis_position = event.value
-        axis_min = -1.0
-        axis_max = 1.0
-
-        if 'axis swap' in axis_config:
-            if axis_config['axis swap'] is True:
-                axis_position = -axis_position
         # Normalize axis position to range 0..1
-        axis_position = (axis_position - axis_min) / (axis_max - axis_min)
-        self.logger.info("speedbrake axis position is %s", axis_position)
-        if axis_position < axis_config['limit stowed']:
-            self.logger.info("speedbrake STOWED")
+        axis_position = axis_config.normalize(event.value)
+        self.hot_log.debug("speedbrake axis position is %s", axis_position)
+        if axis_position < axis_config.limit_stowed:
+            self.hot_log.info("speedbrake STOWED")
             psx_value = int(0)
-        elif axis_position < axis_config['limit armed']:
-            self.logger.info("speedbrake ARMED")
+        elif axis_position < axis_config.limit_armed:
+            self.hot_log.info("speedbrake ARMED")
             psx_value = int(41)
-        elif axis_position > axis_config['limit flight upper']:
-            self.logger.info("speedbrake MAX GROUND")
+        elif axis_position > axis_config.limit_flight_upper:
+            self.hot_log.info("speedbrake MAX GROUND")
             psx_value = int(800)
         else:
             # Flight range
-            flightrange_axis = axis_config['limit flight upper'] - axis_config['limit armed']
+            flightrange_axis = axis_config.limit_flight_upper - axis_config.limit_armed
             flightrange_psx = 375 - 61
             psx_per_axis_unit = flightrange_psx / flightrange_axis
-            psx_speedbrake = 61 + (axis_position - axis_config['limit armed']) * psx_per_axis_unit
+            psx_speedbrake = 61 + (axis_position - axis_config.limit_armed) * psx_per_axis_unit
             psx_value = int(psx_speedbrake)
-            self.logger.info("speedbrake FLIGHT %s", psx_value)
-
-        await self.psx_axis_queue.put({
-            'variable': axis_config['psx variable'],
-            'indexes': [0],
-            'value': psx_value,
-        })
-
-    async def handle_throttle_reverse_button(self, mode, joystick_name, event, config, reverse):  # pylint:disable=too-many-arguments,too-many-locals,too-many-branches,too-many-positional-arguments,too-many-statements
-        """Handle throttle with thrust reverser button."""
-        if 'axis min' in config:
-            axis_min = config['axis min']
-        else:
-            axis_min = -1.0
-        if 'axis max' in config:
-            axis_max = config['axis max']
-        else:
-            axis_max = 1.0
-
-        def get_axis_mode(axis):
-            if joystick_name not in self.axis_reverse_mode:
-                self.axis_reverse_mode[joystick_name] = {}
-            if axis not in self.axis_reverse_mode[joystick_name]:
-                self.axis_reverse_mode[joystick_name][axis] = 'normal'
-            try:
-                return self.axis_reverse_mode[joystick_name][axis]
-            except KeyError:
-                return 'normal'
-
-        def set_axis_mode(axis, mode):
-            self.axis_reverse_mode[joystick_name][axis] = mode
-
-        if mode == 'button':
-            axis_position = self.joystick_get_axis_position(joystick_name, config['axis'])
-            axis_config = self.config[joystick_name]['axis motion'][config['axis']]
-            if axis_position > axis_config['reverse lever unlocked range'][1]:
-                self.logger.info("Cannot toggle reverse, lever position %s", axis_position)
-                return
-            if axis_position < axis_config['reverse lever unlocked range'][0]:
-                self.logger.info("Cannot toggle reverse, lever position %s", axis_position)
-                return
+            self.hot_log.info("speedbrake FLIGHT %s", psx_value)
+
+        await self.queue_psx_axis(event, axis_config, axis_config.psx_variable,
+                                  axis_config.indexes, psx_value)
+
+    def get_axis_mode(self, joystick_name, axis):
+        """Get the reverse mode ('normal' or 'reverse') of a throttle axis."""
+        return self.axis_reverse_mode.get(joystick_name, {}).get(axis, 'normal')
+
+    def set_axis_mode(self, joystick_name, axis, mode):
+        """Set the reverse mode ('normal' or 'reverse') of a throttle axis."""
+        if joystick_name not in self.axis_reverse_mode:
+            self.axis_reverse_mode[joystick_name] = {}
+        self.axis_reverse_mode[joystick_name][axis] = mode
+
+    async def handle_axis_motion_throttle(self, event, axis_config):
+        """Handle motion on a throttle axis with thrust reverser button."""
+        reverse = self.get_axis_mode(axis_config.joystick_name, axis_config.axis) == 'reverse'
+        await self.handle_throttle_reverse_button(event, axis_config, event.value, reverse)
+
+    async def handle_button_reverse_lever(self, event, button_config):
+        """Toggle reverse mode for a throttle axis."""
+        axis_config = button_config.axis_config
+        axis_position = self.joystick_get_axis_position(
+            axis_config.joystick_name, axis_config.axis)
+        unlocked_range = axis_config.reverse_unlocked_range
+        if axis_position > unlocked_range[1]:
+            self.logger.info("Cannot toggle reverse, lever position %s", axis_position)
+            return
+        if axis_position < unlocked_range[0]:
+            self.logger.info("Cannot toggle reverse, lever position %s", axis_position)
+            return
 
-            if get_axis_mode(config['axis']) == 'normal':
-                self.logger.info("Set axis mode for axis %s to reverse", config['axis'])
-                set_axis_mode(config['axis'], 'reverse')
-                reverse = True
-            else:
-                self.logger.info("Set axis mode for axis %s to normal", config['axis'])
-                set_axis_mode(config['axis'], 'normal')
-                reverse = False
+        if self.get_axis_mode(axis_config.joystick_name, axis_config.axis) == 'normal':
+            self.logger.info("Set axis mode for axis %s to reverse", axis_config.axis)
+            self.set_axis_mode(axis_config.joystick_name, axis_config.axis, 'reverse')
+            reverse = True
         else:
-            reverse = bool(get_axis_mode(event.axis) == 'reverse')
-            axis_position = event.value
-            axis_config = config
-
-        # Apply static zones to pygame axis value
-        if 'static zones' in axis_config:
-            for zone in axis_config['static zones']:
-                if zone[1] >= axis_position >= zone[0]:
-                    self.logger.info("In static zone: %s -> %s", axis_position, zone[2])
-                    axis_position = zone[2]
-        # Swap axis if needed
-        if 'axis swap' in axis_config:
-            if axis_config['axis swap'] is True:
-                axis_position = -axis_position
-        # Normalize
-        axis_normalized = (axis_position - axis_min) / (axis_max - axis_min)
-        # Convert to PSX value
+            self.logger.info("Set axis mode for axis %s to normal", axis_config.axis)
+            self.set_axis_mode(axis_config.joystick_name, axis_config.axis, 'normal')
+            reverse = False
+        if axis_config.zone_hysteresis:
+            # Not in the lookup table, see CompiledAxis.static_zone()
+            axis_position = axis_config.static_zone(
+                axis_position, self.axis_zones.get((event.instance_id, axis_config.axis), -1))[0]
+        await self.handle_throttle_reverse_button(event, axis_config, axis_position, reverse)
+
+    async def handle_throttle_reverse_button(self, event, axis_config, axis_position, reverse):
+        """Handle throttle with thrust reverser button."""
         if reverse:
-            psx_min = axis_config['psx reverse idle']
-            psx_max = axis_config['psx reverse full']
-            psx_range = psx_max - psx_min
-            psx_value = int(psx_min + psx_range * axis_normalized)
-            # Never send a value outside the expected range
-            psx_value = max(psx_max, psx_value)
-            psx_value = min(psx_min, psx_value)
+            psx_value = axis_config.reverse_table[lut_index(axis_position)]
         else:
-            psx_min = axis_config['psx idle']
-            psx_max = axis_config['psx full']
-            psx_range = psx_max - psx_min
-            psx_value = int(psx_min + psx_range * axis_normalized)
-            # Never send a value outside the expected range
-            psx_value = min(psx_max, psx_value)
-            psx_value = max(psx_min, psx_value)
+            psx_value = axis_config.table[lut_index(axis_position)]
 
         if self.autothrottle_active():
-            self.logger.info("Throttle movement to %s, but A/T active, blocking", psx_value)
-            tla = int(self.psx.get('Tla').split(';')[axis_config['engine indexes'][0]])
-            self.logger.info("This Tla is %s", tla)
+            self.hot_log.info("Throttle movement to %s, but A/T active, blocking", psx_value)
+            self.stats.count(('blocked by A/T', axis_config.name))
+            try:
+                tla = self.psx_state.tla_record[axis_config.indexes[0]]
+            except PsxCodecException as exc:
+                # Tla is parsed here, not when it arrives from PSX
+                self.hot_log.warning("Could not parse PSX Tla, not checking sync: %s", exc)
+                return
+            self.hot_log.info("This Tla is %s", tla)
             diff = abs(tla - psx_value)
             if diff < 100:
-                self.logger.info("Axis is close to Tla angle - diff=%s", diff)
-                pygame.mixer.Sound(self.config_misc["THROTTLE_SYNC_SOUND"]).play()
+                self.hot_log.info("Axis is close to Tla angle - diff=%s", diff)
+                self.sound_cues.play('THROTTLE_SYNC')
             else:
-                self.logger.info("Axis is far from Tla angle - diff=%s", diff)
+                self.hot_log.info("Axis is far from Tla angle - diff=%s", diff)
         else:
-            await self.psx_axis_queue.put({
-                'variable': axis_config['psx variable'],
-                'indexes': axis_config['engine indexes'],
-                'value': psx_value,
-            })
+            await self.queue_psx_axis(event, axis_config, axis_config.psx_variable,
+                                      axis_config.indexes, psx_value)
+
+    async def queue_psx_axis(self, event, axis_config, variable, indexes, value):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """Queue a new value from an axis to be sent to PSX."""
+        t_read = getattr(event, 't_read', None)
+        if t_read is not None:
+            self.stats.record(('read to queue', axis_config.name), time.monotonic_ns() - t_read)
+        await self.psx_axis_queue.put({
+            'variable': variable,
+            'indexes': indexes,
+            'value': value,
+            'source': axis_config.name,
+            't_read': t_read,
+        })
 
     async def handle_axis_motion(self, event):
         """Handle any axis motion."""
-        joystick_name = self.joysticks[event.instance_id].get_name()
-        try:
-            axis_config = self.config[joystick_name]['axis motion'][event.axis]
-        except KeyError:
+        axis_config = self.axis_dispatch.get((event.instance_id, event.axis))
+        if axis_config is None:
             # Not handling this axis
             return
+        if self.axis_event_stale(event):
+            self.stats.count(('dropped stale', axis_config.name))
+            return
+        if self.calibration_learner is not None:
+            self.calibration_learner.record(axis_config.joystick_name, event.axis, event.value)
+        filters = self.axis_filters.get((event.instance_id, event.axis))
+        caught_up = filters is not None and self.filter_axis_event(event, filters)
+        if axis_config.zone_hysteresis:
+            key = (event.instance_id, event.axis)
+            event.value, self.axis_zones[key], held = axis_config.static_zone(
+                event.value, self.axis_zones.get(key, -1))
+            if held:
+                self.stats.count(('zone exits avoided', axis_config.name))
         # Filter out very small movements
         try:
             last_seen = self.axis_cache[event.instance_id][event.axis]
@@ -374,172 +600,358 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
             self.axis_cache[event.instance_id][event.axis] = event.value
         else:
             axis_move_absolute = abs(event.value - last_seen)
-            if axis_move_absolute < self.args.axis_jitter_limit_low:
-                self.logger.debug("Ignoring small move (%s) for axis %s/%s, no action",
-                                  axis_move_absolute, event.instance_id, event.axis)
+            # The last step of a filter catching up is always small
+            if axis_move_absolute < self.args.axis_jitter_limit_low and not caught_up:
+                self.stats.count(('dropped small move', axis_config.name))
+                self.hot_log.debug("Ignoring small move (%s) for axis %s/%s, no action",
+                                   axis_move_absolute, event.instance_id, event.axis)
                 return
             if axis_move_absolute > self.args.axis_jitter_limit_high:
-                self.logger.debug("Ignoring large move (%s) for axis %s/%s, no action",
-                                  axis_move_absolute, event.instance_id, event.axis)
+                self.stats.count(('dropped large move', axis_config.name))
+                self.hot_log.debug("Ignoring large move (%s) for axis %s/%s, no action",
+                                   axis_move_absolute, event.instance_id, event.axis)
                 return
         # Update cache
         self.axis_cache[event.instance_id][event.axis] = event.value
-        self.logger.debug("axis cache: %s", self.axis_cache)
-
-        if axis_config['axis type'] == 'NORMAL':
-            await self.handle_axis_motion_normal(event, axis_config)
-        elif axis_config['axis type'] == 'THROTTLE_WITH_REVERSE_BUTTON':
-            await self.handle_throttle_reverse_button(
-                'axis', joystick_name, event, axis_config, None)
-        elif axis_config['axis type'] == 'SPEEDBRAKE':
-            await self.handle_axis_motion_speedbrake(event, axis_config)
+
+        await axis_config.handler(event, axis_config)
+
+    def axis_event_stale(self, event):
+        """Check if an axis event is too old to bother with.
+
+        That is when it was read more than --max-event-age ago and a
+        newer event for the same axis is already waiting in the
+        queue, so we never drop the last position of an axis.
+        """
+        t_read = getattr(event, 't_read', None)
+        if t_read is None or self.args.max_event_age <= 0:
+            return False
+        if t_read >= self.axis_latest_read.get((event.instance_id, event.axis), t_read):
+            return False
+        return time.monotonic_ns() - t_read > self.args.max_event_age * 1e6
+
+    def filter_axis_event(self, event, filters):
+        """Run the value of an axis event through the filters of the axis.
+
+        Returns True if the filters have caught up with the axis, see
+        settle_axis_filters().
+        """
+        key = (event.instance_id, event.axis)
+        if getattr(event, 'settle', False):
+            # The axis may have moved since the settle event was queued
+            raw_value = self.filter_raw_values.get(key, event.value)
         else:
-            raise FrankenUsbException(f"Unknown axis type {axis_config['axis type']}")
+            raw_value = self.filter_raw_values[key] = event.value
+        t_read = getattr(event, 't_read', None)
+        if t_read is None:
+            t_read = time.monotonic_ns()
+        event.value = filters.process(raw_value, t_read / 1e9)
+        return self.settle_axis_filters(event, raw_value)
+
+    def settle_axis_filters(self, event, raw_value):
+        """Make sure a filtered axis ends up where the axis stopped.
+
+        Pygame only sends events when an axis moves, so a filter that
+        lags behind (EMA, rate limit...) would be left short of the
+        final position when the axis stops. While the filtered value
+        is off, the newest raw value is fed again every
+        FILTER_SETTLE_INTERVAL until the filters catch up.
+
+        Returns True if the filters have caught up, then the event
+        gets the raw value.
+        """
+        key = (event.instance_id, event.axis)
+        handle = self.filter_settle_handles.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+        if abs(event.value - raw_value) <= FILTER_SETTLE_EPSILON:
+            event.value = raw_value
+            return True
+
+        def settle():
+            del self.filter_settle_handles[key]
+            self.axis_event_queue.put_nowait(pygame.event.Event(
+                pygame.JOYAXISMOTION,
+                instance_id=event.instance_id, axis=event.axis, value=raw_value, settle=True))
+
+        self.filter_settle_handles[key] = asyncio.get_running_loop().call_later(
+            FILTER_SETTLE_INTERVAL, settle)
+        return False
+
+    async def handle_button_set(self, event, button_config):
+        """Set a PSX variable to the value in config."""
+        self.psx_send_and_set(button_config.psx_variable, button_config.value,
+                              getattr(event, 't_read', None))
+
+    async def handle_button_increment(self, event, button_config):
+        """Increment a PSX variable, optionally limited to min/max or wrapping."""
+        value = int(self.psx.get(button_config.psx_variable))
+        new_value = value + button_config.increment
+        if button_config.min is not None and new_value < button_config.min:
+            if button_config.wrap:
+                new_value = button_config.max
+            else:
+                new_value = button_config.min
+        elif button_config.max is not None and new_value > button_config.max:
+            if button_config.wrap:
+                new_value = button_config.min
+            else:
+                new_value = button_config.max
+        if new_value != value:
+            self.psx_send_and_set(button_config.psx_variable, new_value,
+                                  getattr(event, 't_read', None))
+
+    async def handle_button_bigmompsh(self, event, button_config):
+        """Set the lowest bit in a PSX variable."""
+        self.logger.debug("BIGMOMPSH event for %s", button_config.psx_variable)
+        value = int(self.psx.get(button_config.psx_variable))
+        new_value = value | 1
+        if new_value != value:
+            self.psx_send_and_set(button_config.psx_variable, new_value,
+                                  getattr(event, 't_read', None))
+
+    async def handle_button_towing_heading(self, _, button_config):
+        """Change the towing heading."""
+        self.towing_heading_change(button_config.increment)
+
+    async def handle_button_towing_direction_toggle(self, _, __):
+        """Toggle the towing direction."""
+        self.towing_direction_toggle()
+
+    async def handle_button_towing_mode_toggle(self, _, __):
+        """Toggle the towing mode."""
+        self.towing_mode_toggle()
+
+    async def handle_button_tiller_toggle(self, _, __):
+        """Switch between using the tiller axis as aileron and tiller."""
+        if self.aileron_tiller_active:
+            # Remove warning, centre aileron and tiller, disable tiller mode
+            self.psx.send(TILLER_MSG, "")
+            self.centre_ailerons_and_tiller()
+            self.aileron_tiller_active = False
+        else:
+            # Display warning message, centre aileron and tiller, enable tiller mode
+            self.psx.send(TILLER_MSG, "TILLER ACTIVE")
+            self.centre_ailerons_and_tiller()
+            # Enable tiller mode
+            self.aileron_tiller_active = True
+
+    async def handle_button_action_runway_entry(self, _, __):
+        """Transponder TARA, all lights except outer landing lights on."""
+        self.logger.info("Runway entry action: NOT IMPLEMENTED")
+
+    async def handle_button_action_cleared_takeoff(self, _, __):
+        """Outer landing lights on."""
+        self.logger.info("Cleared takeoff action: NOT IMPLEMENTED")
 
-    async def handle_button(self, event):  # pylint: disable=too-many-branches,too-many-statements
+    async def handle_button_action_exited_runway(self, _, __):
+        """Transponder standby, landing lights off, taxi lights on, APU start, autobrake disable."""
+        self.logger.info("Runway exited action: NOT IMPLEMENTED")
+
+    async def handle_button(self, event):
         """Handle button press/release."""
-        direction = 'up' if event.type == pygame.JOYBUTTONUP else 'down'
-        joystick_name = self.joysticks[event.instance_id].get_name()
-        try:
-            button_config = self.config[joystick_name][f"button {direction}"][event.button]
-        except KeyError:
+        button_config = self.button_dispatch.get((event.instance_id, event.button, event.type))
+        if button_config is None:
             # Not handling this button/direction
             return
-        if button_config['button type'] == "SET":
-            # Set a PSX variable to the value in config
-            self.psx_send_and_set(button_config['psx variable'], button_config['value'])
-        elif button_config['button type'] == "REVERSE_LEVER":
-            if direction == 'down':
-                # mode, joystick_name, event, config, reverse
-                await self.handle_throttle_reverse_button(
-                    'button', joystick_name, event, button_config, False)
-            else:
-                await self.handle_throttle_reverse_button(
-                    'button', joystick_name, event, button_config, True)
-        elif button_config['button type'] == 'INCREMENT':
-            value = int(self.psx.get(button_config['psx variable']))
-            increment = int(button_config['increment'])
-            new_value = value + increment
-            wrap = False
-            if 'wrap' in button_config and button_config['wrap'] is True:
-                wrap = True
-            if 'min' in button_config and new_value < button_config['min']:
-                if wrap:
-                    new_value = button_config['max']
-                else:
-                    new_value = button_config['min']
-            elif 'max' in button_config and new_value > button_config['max']:
-                if wrap:
-                    new_value = button_config['min']
-                else:
-                    new_value = button_config['max']
-            if new_value != value:
-                self.psx_send_and_set(button_config['psx variable'], new_value)
-        elif button_config['button type'] == 'BIGMOMPSH':
-            self.logger.debug("BIGMOMPSH event for %s", button_config['psx variable'])
-            value = int(self.psx.get(button_config['psx variable']))
-            new_value = value | 1
-            if new_value != value:
-                self.psx_send_and_set(button_config['psx variable'], new_value)
-        elif button_config['button type'] == 'TOWING_HEADING':
-            self.towing_heading_change(button_config['increment'])
-        elif button_config['button type'] == 'TOWING_DIRECTION_TOGGLE':
-            self.towing_direction_toggle()
-        elif button_config['button type'] == 'TOWING_MODE_TOGGLE':
-            self.towing_mode_toggle()
-        elif button_config['button type'] == 'TILLER_TOGGLE':
-            if self.aileron_tiller_active:
-                # Remove warning, centre aileron and tiller, disable tiller mode
-                self.psx.send(TILLER_MSG, "")
-                self.centre_ailerons_and_tiller()
-                self.aileron_tiller_active = False
-            else:
-                # Display warning message, centre aileron and tiller, enable tiller mode
-                self.psx.send(TILLER_MSG, "TILLER ACTIVE")
-                self.centre_ailerons_and_tiller()
-                # Enable tiller mode
-                self.aileron_tiller_active = True
-        elif button_config['button type'] == 'ACTION_RUNWAY_ENTRY':
-            # Transponder TARA, all lights except outer landing lights on
-            self.logger.info("Runway entry action: NOT IMPLEMENTED")
-        elif button_config['button type'] == 'ACTION_CLEARED_TAKEOFF':
-            # Outer landing lights on
-            self.logger.info("Cleared takeoff action: NOT IMPLEMENTED")
-        elif button_config['button type'] == 'ACTION_EXITED_RUNWAY':
-            # Transponder standby, landing lights off, taxi lights on, APU start, autobrake disable
-            self.logger.info("Runway exited action: NOT IMPLEMENTED")
+        await button_config.handler(event, button_config)
+
+    async def handle_pygame_event(self, thisevent):
+        """Handle a single pygame event."""
+        t_read = getattr(thisevent, 't_read', None)
+        if t_read is not None:
+            self.stats.record('read to handler', time.monotonic_ns() - t_read)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # Scalars only, the log record is formatted later in another
+            # thread and handle_axis_motion() changes the event value
+            self.hot_log.debug(
+                "handle_pygame_events got %s instance %s axis %s button %s value %s",
+                pygame.event.event_name(thisevent.type), getattr(thisevent, 'instance_id', None),
+                getattr(thisevent, 'axis', None), getattr(thisevent, 'button', None),
+                getattr(thisevent, 'value', None))
+        if thisevent.type == pygame.JOYAXISMOTION:
+            await self.handle_axis_motion(thisevent)
+        elif thisevent.type in [pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP]:
+            await self.handle_button(thisevent)
+        elif thisevent.type == pygame.JOYDEVICEADDED:
+            self.handle_device_added(thisevent)
+        elif thisevent.type == pygame.JOYDEVICEREMOVED:
+            self.handle_device_removed(thisevent)
         else:
-            raise FrankenUsbException(f"Unknown button type {button_config['button type']}")
+            raise FrankenUsbException(f"Got event type we do not handle: {thisevent.type}")
 
     async def handle_pygame_events(self):
-        """Read pygame events from queue and handle them."""
+        """Read pygame events from queue and handle them.
+
+        Each time we wake up we handle everything in the queue, up to
+        --event-batch-size events. After that we yield to the other
+        coroutines before handling the rest.
+        """
         while True:
-            thisevent = await self.axis_event_queue.get()
-            self.logger.debug("handle_pygame_events got %s", thisevent)
-            if thisevent.type == pygame.JOYAXISMOTION:
-                await self.handle_axis_motion(thisevent)
-            elif thisevent.type in [pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP]:
-                await self.handle_button(thisevent)
-            else:
-                raise FrankenUsbException(f"Got event type we do not handle: {thisevent.type}")
-            await asyncio.sleep(0.01)
+            await self.handle_pygame_event(await self.axis_event_queue.get())
+            handled = 1
+            while handled < self.args.event_batch_size:
+                try:
+                    thisevent = self.axis_event_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                await self.handle_pygame_event(thisevent)
+                handled += 1
+            await asyncio.sleep(0)
+
+    def coalesce_pygame_events(self, events, t_read=None):
+        """Split pygame events into axis and other (button, device) events.
+
+        To avoid overloading the event handler, only the last event
+        for a certain axis is kept. Events we won't handle anyway are
+        filtered out. All events are tagged with the time we read
+        them (t_read, time.monotonic_ns(), now unless given).
+        """
+        if t_read is None:
+            t_read = time.monotonic_ns()
+        if self.recorder is not None:
+            self.recorder.record(events, t_read, self.joystick_get_name)
+        axis_events = {}
+        other_events = []
+        coalesced = 0
+        for event in events:
+            if event.type == pygame.JOYAXISMOTION:
+                event.t_read = t_read
+                if (event.instance_id, event.axis) in axis_events:
+                    coalesced += 1
+                axis_events[(event.instance_id, event.axis)] = event
+            elif event.type in [pygame.JOYBUTTONUP, pygame.JOYBUTTONDOWN,
+                                pygame.JOYDEVICEADDED, pygame.JOYDEVICEREMOVED]:
+                event.t_read = t_read
+                other_events.append(event)
+        return axis_events, other_events, coalesced
+
+    def queue_pygame_events(self, axis_events, other_events, coalesced):
+        """Put coalesced pygame events in the event queue."""
+        if coalesced:
+            self.stats.count('coalesced in reader', coalesced)
+        if self.axis_event_queue.qsize() > 10:
+            self.logger.warning("WARNING: event queue size: %d",
+                                self.axis_event_queue.qsize())
+        for event in other_events:
+            # The queue is unbounded, so we never drop button or device events.
+            self.axis_event_queue.put_nowait(event)
+        for key, event in axis_events.items():
+            self.axis_latest_read[key] = event.t_read
+            # It's OK to drop axis events if the queue is full
+            try:
+                self.axis_event_queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.stats.count('dropped as queue full')
+                self.logger.warning("Dropping pygame axis events as queue is full")
+
+    def queue_input_process_events(self, batches, overruns, unknown):
+        """Put events from the input process in the event queue.
+
+        Joysticks that were plugged in are added right away, so the
+        events after them find their dispatch tables. overruns and
+        unknown are the number of records lost since the last call,
+        and the number skipped as their joystick was not known.
+        """
+        if overruns:
+            self.stats.count('input ring overruns', overruns)
+            self.logger.warning("Lost %d events from the input process", overruns)
+        if unknown:
+            self.stats.count('input unknown joystick', unknown)
+            self.logger.warning("Skipped %d events from the input process for unknown joysticks,"
+                                " asked it to send its joysticks again", unknown)
+        for t_read, events in batches:
+            other_events = []
+            for event in events:
+                if event.type == pygame.JOYDEVICEADDED:
+                    joy = self.input_process.joysticks.get(event.instance_id)
+                    if joy is not None and joy.get_name() in self.compiled_config:
+                        self.add_joystick(joy)
+                else:
+                    other_events.append(event)
+            self.queue_pygame_events(*self.coalesce_pygame_events(other_events, t_read))
 
-    async def read_pygame_events(self):  # pylint: disable=too-many-branches
-        """Read pygame events from queue and handle them."""
+    def input_process_reader_thread(self, loop):
+        """Wait for the input process and hand its events to the asyncio loop.
+
+        Runs in a separate thread, so events are handed over as soon
+        as the input process has read and timestamped them.
+        """
+        overruns = 0
+        unknown = 0
+        while True:
+            if not self.psx_connected:
+                self.logger.warning("PSX not connected, not reading any pygame events")
+                time.sleep(1.0)
+                continue
+            if not self.input_process.wait(1.0):
+                if not self.input_process.is_alive():
+                    self.logger.error("Input process has stopped, no more joystick events")
+                    return
+                continue
+            batches = self.input_process.read()
+            if (batches or self.input_process.overruns != overruns
+                    or self.input_process.unknown != unknown):
+                loop.call_soon_threadsafe(self.queue_input_process_events, batches,
+                                          self.input_process.overruns - overruns,
+                                          self.input_process.unknown - unknown)
+                overruns = self.input_process.overruns
+                unknown = self.input_process.unknown
+
+    async def read_pygame_events(self):
+        """Read pygame events and put them in the event queue."""
+        if self.replayer is not None:
+            while not self.psx_connected:
+                self.logger.warning("PSX not connected, not starting replay")
+                await asyncio.sleep(1.0)
+            self.logger.info("Replaying events from %s", self.args.replay)
+            count = await self.replayer.run(self)
+            self.logger.info("Replay finished, %d events", count)
+            self.log_stats()
+            return
+        if self.input_process is not None:
+            thread = threading.Thread(target=self.input_process_reader_thread,
+                                      args=(asyncio.get_running_loop(),),
+                                      name="input process reader", daemon=True)
+            thread.start()
+            return
+        # Fallback: poll pygame for events
         while True:
             if not self.psx_connected:
                 self.logger.warning("PSX not connected, not reading any pygame events")
                 await asyncio.sleep(1.0)
                 continue
-            if self.axis_event_queue.qsize() > 10:
-                self.logger.warning("WARNING: event queue size: %d",
-                                    self.axis_event_queue.qsize())
-            axis_events = {}
-            other_events = []
-            for event in pygame.event.get():
-                # Filter out events we won't handle anyway
-                if event.type == pygame.JOYAXISMOTION:
-                    # To avoid overloading the event handler, cache
-                    # the events and only put the last event for a
-                    # certain axis in the queue.
-                    axis_events[(event.instance_id, event.axis)] = event
-                elif event.type in [pygame.JOYBUTTONUP, pygame.JOYBUTTONDOWN]:
-                    other_events.append(event)
-            for event in other_events:
-                # If queue is full, we wait until a slot is available,
-                # we never want to drop button events.
-                await self.axis_event_queue.put(event)
-            for _, event in axis_events.items():
-                # It's OK to drop axis events if the queue is full
-                try:
-                    self.axis_event_queue.put_nowait(event)
-                except asyncio.QueueFull:
-                    self.logger.warning("Dropping pygame axis events as queue is full")
-            # 0.01s here leads to a buildup of events in the queue
-            # when moving two axes. Why? Not enough time left over for
-            # the other coroutines that will process the events? 0.05s
-            # seems fine.
-            await asyncio.sleep(0.05)
+            self.queue_pygame_events(*self.coalesce_pygame_events(pygame.event.get()))
+            await asyncio.sleep(POLL_INTERVAL)
 
     def autothrottle_active(self):
-        """Check if the autothrottle is managing the levers.
+        """Check if the autothrottle is managing the levers."""
+        return self.psx_state.at_active
 
-        If the AFDS mode is blank or HOLD, we own the levers :)
-
-        BLANK = 0
-        HOLD = 21
-        Source: https://aerowinx.com/board/index.php/topic,4408.msg72250.html#msg72250
-        """
-        afds = self.psx.get("Afds")
-        atmode = int(afds.split(';')[0])
-        if atmode in [0, 21]:
-            return False
-        return True
+    def update_psx_state(self, key, value):
+        """Update the parsed PSX state cache with a new value."""
+        try:
+            self.psx_state_setters[key](value)
+        except (PsxCodecException, ValueError, AttributeError) as exc:
+            self.logger.warning("Could not parse PSX %s=%s: %s", key, value, exc)
+
+    def psx_variable_changed(self, key, value):
+        """Update our parsed copies of a PSX variable with a new value."""
+        vector = self.psx_vectors.get(key)
+        if vector is not None:
+            vector.received(value)
+        if key in self.psx_state_setters:
+            self.update_psx_state(key, value)
 
     def print_psx_variable(self, key, value):
         """Log the value of a PSX variable."""
         self.logger.info("PSX variable %s is now %s", key, value)
 
+    def psx_afds_changed(self, key, value):
+        """Log and cache a new Afds value."""
+        self.print_psx_variable(key, value)
+        self.psx_variable_changed(key, value)
+
     async def setup_psx_connection(self):
         """Set up the PSX connection."""
         def setup():
@@ -558,19 +970,19 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
         def connected(key, value):
             self.logger.info("Connected to PSX %s %s as #%s", key, value, self.psx.get('id'))
             self.psx_connected = True
+            # A new PSX may have a new lexicon
+            self.psx_wire_keys = {}
 
-        self.psx = psx.Client()
+        if self.args.psx_host is None and self.args.psx_port is None:
+            self.psx = psx.Client()
+        else:
+            self.psx = psx.Client(host=self.args.psx_host or "127.0.0.1",
+                                  port=self.args.psx_port or 10747)
         self.psx.logger = self.logger.debug  # .info to see traffic
 
         self.psx.subscribe("id")
         self.psx.subscribe("version", connected)
 
-        # Needed for tiller mode
-        self.psx.subscribe("Tiller")
-
-        # Needed for autothrottle
-        self.psx.subscribe("Afds", self.print_psx_variable)
-
         self.psx.onResume = setup
         self.psx.onPause = teardown
         self.psx.onDisconnect = teardown
@@ -584,34 +996,206 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
                         psx_variables.add(action['psx variable'])
         self.logger.info("Subscribing to PSX variables %s", psx_variables)
         for psx_variable in psx_variables:
-            self.psx.subscribe(psx_variable)
+            self.psx.subscribe(psx_variable, self.psx_variable_changed)
+
+        # Subscribed after the config variables so the callbacks are
+        # not replaced. Tiller is sent in tiller mode, Afds and Tla are
+        # parsed into self.psx_state for the autothrottle.
+        self.psx.subscribe("Tiller", self.psx_variable_changed)
+        self.psx.subscribe("Afds", self.psx_afds_changed)
+        self.psx.subscribe("Tla", self.psx_variable_changed)
         self.logger.info("PSX subscribed variables: %s", ', '.join(self.psx.variables.keys()))
         # Nothing happens until we connect()
         await self.psx.connect()
 
-    def psx_send_and_set(self, psx_variable, new_psx_value):
-        """Send variable to PSX and store in local db."""
+    def psx_set_local(self, psx_variable, new_psx_value):
+        """Store a value we have sent to PSX in psx.py and our parsed copies."""
+        self.psx._set(psx_variable, new_psx_value)  # pylint: disable=protected-access
+        self.psx_variable_changed(psx_variable, new_psx_value)
+
+    def psx_send_and_set(self, psx_variable, new_psx_value, t_read=None):
+        """Send variable to PSX and store in local db.
+
+        t_read is when the button event that caused the send was read,
+        if we have it, for the latency statistics.
+        """
         self.logger.debug("TO PSX: %s -> %s", psx_variable, new_psx_value)
         self.psx.send(psx_variable, new_psx_value)
-        self.psx._set(psx_variable, new_psx_value)  # pylint: disable=protected-access
+        if t_read is not None:
+            latency = time.monotonic_ns() - t_read
+            self.stats.record(('read to wire', psx_variable), latency)
+            self.stats.record(WIRE_LATENCY_BUTTONS, latency)
+        self.psx_set_local(psx_variable, new_psx_value)
+
+    def psx_axis_store(self, thisevent):
+        """Store the new value(s) from an axis event in psx_send_state.
 
-    async def psx_axis_sender(self):  # pylint: disable=too-many-branches
+        If the variable is not already waiting to be sent, it is
+        scheduled for the first time the rate limit allows.
+        """
+        variable = thisevent['variable']
+        state = self.psx_send_state[variable]
+        if 'new data' not in state:
+            state['new data'] = {}
+            state['t_read'] = {}
+        for index in thisevent['indexes']:
+            state['new data'][index] = thisevent['value']
+        if thisevent.get('t_read') is not None:
+            if thisevent['source'] in state['t_read']:
+                self.stats.count(('coalesced in sender', variable))
+            state['t_read'][thisevent['source']] = thisevent['t_read']
+        if not state.get('scheduled', False):
+            state['scheduled'] = True
+            deadline = state.get('last sent', 0) + self.psx_send_interval(variable)
+            heapq.heappush(self.psx_send_heap, (deadline, variable))
+
+    def psx_send_interval(self, variable):
+        """Get the minimum time (ns) between two sends of variable.
+
+        From CONFIG_MISC['PSX_MAX_RATES'] if the variable is there,
+        else --max-rate, longer while backing off.
+        """
+        state = self.psx_send_state[variable]
+        if 'interval' not in state:
+            max_rate = self.config_misc.get('PSX_MAX_RATES', {}).get(variable, self.args.max_rate)
+            state['base interval'] = int(1e9 / max_rate)
+            state['interval'] = state['base interval']
+        return state['interval']
+
+    def psx_adapt_rates(self, writer, variables):
+        """Back off or recover the send rate of variables.
+
+        If PSX is not reading as fast as we write, data piles up in
+        the writer's transport buffer. Then we halve the rate of the
+        variables we just sent (down to 1/MAX_RATE_BACKOFF of their
+        max rate), and double it again when the buffer has emptied.
+        """
+        try:
+            buffered = writer.transport.get_write_buffer_size()
+        except AttributeError:
+            return
+        for variable in variables:
+            state = self.psx_send_state[variable]
+            interval = self.psx_send_interval(variable)
+            if buffered > self.args.adaptive_rate_buffer:
+                interval = min(interval * 2, state['base interval'] * MAX_RATE_BACKOFF)
+                self.stats.count(('rate backoff', variable))
+            elif buffered == 0:
+                interval = max(interval // 2, state['base interval'])
+            if interval != state['interval']:
+                self.logger.debug("Send rate for %s is now %.1f Hz", variable, 1e9 / interval)
+                state['interval'] = interval
+
+    def psx_wire_key(self, variable):
+        """Get the Q code PSX knows variable by, None if we don't know it.
+
+        Looked up in the lexicon psx.py got from PSX, without changing
+        it. If psx.py does not have one we can read, or the variable
+        is not in it, we leave writing the variable to psx.send().
+        """
+        key = self.psx_wire_keys.get(variable)
+        if key is None:
+            lexicon = getattr(self.psx, 'lexicon', None)
+            if not isinstance(lexicon, dict):
+                return None
+            for code, name in lexicon.items():
+                if name == variable and isinstance(code, str) and PSX_Q_CODE.match(code):
+                    key = self.psx_wire_keys[variable] = code
+                    break
+        return key
+
+    def psx_axis_send(self, variable, now, lines):
+        """Send the new data for variable to PSX at now (time.monotonic_ns()).
+
+        The new data is merged into the fields of the variable we
+        have in psx_vectors, and the variable is sent unless that
+        did not change anything. If lines is a list and we know the
+        Q code of the variable, it is added to lines as a key=value
+        line for the caller to write, else it is sent with psx.send().
+        """
+        data = self.psx_send_state[variable]
+        data['scheduled'] = False
+        if 'new data' not in data or len(data['new data']) == 0:
+            # No data to send for this variable
+            return
+        vector = self.psx_vectors.get(variable)
+        if vector is None:
+            # From now on kept up to date by psx_variable_changed()
+            vector = self.psx_vectors[variable] = PsxVector(variable, self.psx.get(variable))
+        for index, value in data['new data'].items():
+            vector.set(index, value)
+        data['new data'] = {}
+        new_psx_value = vector.emit()
+        if new_psx_value is None:
+            # PSX already has this value (from us or someone else),
+            # e.g a rudder held in a static zone, don't send it again
+            self.stats.count(('suppressed unchanged', variable))
+            data['t_read'] = {}
+            return
+        key = self.psx_wire_key(variable) if lines is not None else None
+        if key is None:
+            self.psx_send_and_set(variable, new_psx_value)
+        else:
+            self.logger.debug("TO PSX: %s -> %s", variable, new_psx_value)
+            lines.append(f"{key}={new_psx_value}\n")
+            self.psx_set_local(variable, new_psx_value)
+        data['last sent'] = now
+        for source, t_read in data['t_read'].items():
+            self.stats.record(('read to wire', source), now - t_read)
+            self.stats.record(('read to wire', variable), now - t_read)
+            self.stats.record(WIRE_LATENCY_AXES, now - t_read)
+        data['t_read'] = {}
+
+    async def psx_axis_flush(self, now):
+        """Send all variables due at now (time.monotonic_ns()) to PSX as one block.
+
+        psx.send() writes each variable straight to the socket, so we
+        put the key=value lines together ourselves, write them to the
+        PSX connection in one go and drain once. Fewer syscalls and
+        TCP segments for the PSX main server to handle.
+        """
+        if not self.psx_send_heap or self.psx_send_heap[0][0] > now:
+            return
+        # Without a writer to write lines to, psx.send() does it all
+        writer = getattr(self.psx, 'writer', None)
+        lines = [] if writer is not None else None
+        variables = []
+        while self.psx_send_heap and self.psx_send_heap[0][0] <= now:
+            _, variable = heapq.heappop(self.psx_send_heap)
+            self.psx_axis_send(variable, now, lines)
+            variables.append(variable)
+        if writer is None:
+            return
+        if len(lines) > 1:
+            self.stats.count('batched sends', len(lines))
+        try:
+            if lines:
+                writer.write(''.join(lines).encode())
+            if self.args.adaptive_rate_buffer > 0:
+                self.psx_adapt_rates(writer, variables)
+            await writer.drain()
+        except ConnectionError as exc:
+            self.logger.warning("Failed to send axis data to PSX: %s", exc)
+
+    async def psx_axis_sender(self):
         """Send axis data to PSX.
 
         Pygame axis events can easily arrive faster than we want to
         push data to PSX, to those variables are handled like this:
 
-        if variable not in psx_send_state
-          send variable to PSX and store the time and last value sent in psx_send_state
-        else
-          check elapsed time since last send
-          if enough time elapsed
-            send variable to PSX and store the time and last value sent in psx_send_state
-          else
-            store value we want to send in psx_send_state
+        store the value we want to send in psx_send_state
+        if the variable is not already scheduled
+          schedule it at the time of the last send + 1 / max rate
+          for the variable (i.e right away if nothing was sent
+          recently)
 
-        We also check psx_send_state on each loop, and if enough time has
-        passed for some variable, we send the saved value to PSX.
+        The schedule is a heap of (time, variable), and we sleep until
+        the earliest scheduled time or until a new axis event arrives,
+        whichever comes first. All times are time.monotonic_ns(), so
+        stepping the wall clock does not upset the rate limit. When
+        nothing is pending we just wait
+        for the queue. All variables due at the same time are sent
+        to PSX as one block, see psx_axis_flush().
 
         Since multiple axes can provide data (e.g elevator and aileron
         both use FltControls) to the same PSX variable, we need to
@@ -621,7 +1205,8 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
         needed.
 
         state["FltControls"] = {
-           'last sent': 12345567.0,
+           'last sent': 1234556789012,
+           'scheduled': True,
            'new data' : {
              0: 576,
              1: 224,
@@ -630,8 +1215,9 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
 
         The above will result in FltControls="576;224;X" being sent to
         PSX where X is the existing value of the third element that we
-        do not update. X will only be read from PSX just before we
-        will update the variable.
+        do not update. X is the last value PSX told us about, the
+        fields of each variable are kept in a PsxVector in psx_vectors
+        (see psx_codec.py).
 
         """
         while True:
@@ -641,46 +1227,109 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
                 continue
             if self.psx_axis_queue.qsize() > 10:
                 self.logger.warning("WARNING: psx_axis queue size: %d", self.psx_axis_queue.qsize())
-            try:
-                # If an event is available, process it
-                thisevent = self.psx_axis_queue.get_nowait()
+            # Store everything already in the queue
+            while True:
                 try:
-                    elapsed = time.time() - self.psx_send_state[thisevent['variable']]['last sent']
-                except KeyError:
-                    elapsed = time.time()  # never sent
-
-                # Store the new value(s) in state
-                for index in thisevent['indexes']:
-                    if 'new data' not in self.psx_send_state[thisevent['variable']]:
-                        self.psx_send_state[thisevent['variable']]['new data'] = {}
-                    self.psx_send_state[
-                        thisevent['variable']]['new data'][index] = thisevent['value']
-                # If enough time has passed sinc the last send, set last sent to zero,
-                # triggering sending to PSX
-                if elapsed > (1.0 / self.args.max_rate):
-                    self.psx_send_state[thisevent['variable']]['last sent'] = 0.0
-            except asyncio.QueueEmpty:
-                # self.logger.debug("No event from PSX queue")
+                    self.psx_axis_store(self.psx_axis_queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            # Send the variables whose time has come
+            now = time.monotonic_ns()
+            await self.psx_axis_flush(now)
+            # Sleep until the next scheduled send or a new axis event
+            timeout = None
+            if self.psx_send_heap:
+                timeout = (self.psx_send_heap[0][0] - now) / 1e9
+            try:
+                self.psx_axis_store(
+                    await asyncio.wait_for(self.psx_axis_queue.get(), timeout))
+            except asyncio.TimeoutError:
                 pass
 
-            # Check self.psx_send_state for variables to send to PSX
-            for variable, data in self.psx_send_state.items():
-                if 'new data' not in data or len(data['new data']) == 0:
-                    # No data to send for this variable
-                    continue
-                elapsed = time.time() - data['last sent']
-                if elapsed > (1.0 / self.args.max_rate):
-                    # Read data from PSX, modify and write back
-                    psx_value = self.psx.get(variable)
-                    elems = psx_value.split(';')
-                    new_data = data['new data']
-                    for index, value in new_data.items():
-                        elems[index] = str(value)
-                    new_psx_value = ";".join(elems)
-                    self.psx_send_and_set(variable, new_psx_value)
-                    data['last sent'] = time.time()
-                    data['new data'] = {}
-            await asyncio.sleep(0.01)
+    def log_stats(self):
+        """Log the latency statistics."""
+        for line in self.stats.report_lines():
+            self.logger.info("STATS %s", line)
+
+    async def stats_logger(self):
+        """Log the latency statistics now and then, and on SIGUSR1 if we have it."""
+        if hasattr(signal, 'SIGUSR1'):
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.log_stats)
+            except NotImplementedError:
+                pass
+        if self.args.stats_interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.args.stats_interval)
+            self.log_stats()
+
+    async def calibration_writer(self):
+        """With --calibrate, write the calibration file now and then."""
+        if self.calibration_learner is None:
+            return
+        self.logger.info("Calibrating, move all axes to both ends, writing to %s",
+                         self.args.calibration_file)
+        while True:
+            await asyncio.sleep(CALIBRATION_WRITE_INTERVAL)
+            if self.calibration_learner.changed:
+                self.calibration_learner.write(self.args.calibration_file)
+                self.logger.info("Wrote calibration to %s", self.args.calibration_file)
+
+    def compile_dispatch(self):
+        """Compile self.config into per-axis and per-button handlers."""
+        try:
+            self.compiled_config = compile_config(
+                self.config,
+                {
+                    'NORMAL': self.handle_axis_motion_normal,
+                    'THROTTLE_WITH_REVERSE_BUTTON': self.handle_axis_motion_throttle,
+                    'SPEEDBRAKE': self.handle_axis_motion_speedbrake,
+                },
+                {
+                    'SET': self.handle_button_set,
+                    'REVERSE_LEVER': self.handle_button_reverse_lever,
+                    'INCREMENT': self.handle_button_increment,
+                    'BIGMOMPSH': self.handle_button_bigmompsh,
+                    'TOWING_HEADING': self.handle_button_towing_heading,
+                    'TOWING_DIRECTION_TOGGLE': self.handle_button_towing_direction_toggle,
+                    'TOWING_MODE_TOGGLE': self.handle_button_towing_mode_toggle,
+                    'TILLER_TOGGLE': self.handle_button_tiller_toggle,
+                    'ACTION_RUNWAY_ENTRY': self.handle_button_action_runway_entry,
+                    'ACTION_CLEARED_TAKEOFF': self.handle_button_action_cleared_takeoff,
+                    'ACTION_EXITED_RUNWAY': self.handle_button_action_exited_runway,
+                },
+                self.calibration)
+        except FrankenUsbConfigException as inst:
+            raise FrankenUsbException(
+                f"Bad config file {self.args.config_file}: {inst}") from inst
+
+    def open_joysticks(self):
+        """Open the joysticks we have at startup, or their stand-ins."""
+        if self.args.replay:
+            try:
+                self.replayer = EventReplayer.from_file(self.args.replay, self.args.replay_speed)
+            except (IOError, FrankenUsbReplayException) as inst:
+                raise FrankenUsbException(f"Failed to read {self.args.replay}: {inst}") from inst
+            for joy in self.replayer.joysticks.values():
+                if joy.get_name() in self.compiled_config:
+                    self.add_joystick(joy)
+            return
+        if self.args.input_backend == 'process':
+            # The input process reads the joysticks, we only get its events
+            pygame.joystick.quit()
+            try:
+                self.input_process = InputProcess()
+                self.input_process.start()
+            except (FrankenUsbShmException, OSError) as inst:
+                self.logger.warning("Failed to start the input process (%s), polling pygame", inst)
+                self.input_process = None
+                pygame.joystick.init()
+            else:
+                self.queue_input_process_events(self.input_process.read(), 0, 0)
+                return
+        for i in range(pygame.joystick.get_count()):
+            self.open_joystick(i)
 
     async def main(self):
         """Start the script."""
@@ -691,30 +1340,49 @@ class FrankenUsb():  # pylint: disable=too-many-instance-attributes,too-many-pub
         except IOError as inst:
             raise FrankenUsbException(
                 f"Failed to open config file {self.args.config_file}: {inst}") from inst
+        if os.path.exists(self.args.calibration_file):
+            try:
+                self.calibration = self.load_module_from_file(
+                    "self.calibration", self.args.calibration_file).CALIBRATION
+            except (IOError, AttributeError) as inst:
+                raise FrankenUsbException(
+                    f"Failed to read calibration file {self.args.calibration_file}: {inst}"
+                ) from inst
+            self.logger.info("Using calibration from %s", self.args.calibration_file)
+        if self.args.calibrate:
+            self.calibration_learner = CalibrationLearner(self.calibration)
+
+        self.compile_dispatch()
 
         pygame.init()
         pygame.joystick.init()
-        for i in range(pygame.joystick.get_count()):
-            joystick_name = pygame.joystick.Joystick(i).get_name()
-            if joystick_name not in self.config:
-                self.logger.debug("Joystick %s (%s) but not configured", i, joystick_name)
-                continue
-            self.logger.debug("Joystick %s found: %s", i, joystick_name)
-            joy = pygame.joystick.Joystick(i)
-            joy.init()
-            self.joysticks[joy.get_instance_id()] = joy
+        self.sound_cues.load(self.config_misc)
+        if self.args.record:
+            self.recorder = EventRecorder(self.args.record)
+        self.open_joysticks()
         if len(self.joysticks) <= 0:
-            raise FrankenUsbException("Found no configured joysticks to watch, exiting")
+            self.logger.warning("Found no configured joysticks, waiting for one to be plugged in")
         await asyncio.gather(
             self.read_pygame_events(),
             self.handle_pygame_events(),
             self.psx_axis_sender(),
+            self.sound_cues.player(),
+            self.stats_logger(),
+            self.calibration_writer(),
             self.setup_psx_connection(),
         )
 
     def run(self):
         """Start everything up."""
-        asyncio.run(self.main())
+        self.log_listener = start_queue_logging()
+        try:
+            asyncio.run(self.main())
+        finally:
+            if self.input_process is not None:
+                self.input_process.stop()
+            if self.recorder is not None:
+                self.recorder.close()
+            self.log_listener.stop()
 
 
 if __name__ == '__main__':
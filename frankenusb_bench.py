@@ -0,0 +1,378 @@
+"""Benchmark the frankenusb input to PSX pipeline.
+
+Runs named scenarios with synthetic joystick input, or a recording
+made with frankenusb --record, against a local PSX stand-in
+(psx_standin.py) and reports, per scenario:
+
+- events/s handled by frankenusb
+- writes/s received by the stand-in
+- p50/p99 input-to-wire latency for axes and buttons (pygame read to
+  psx.send), null if nothing was sent
+- CPU time per event for the frankenusb thread
+
+The result is written as JSON so builds can be compared before they
+are used on the sim, e.g
+
+  python frankenusb_bench.py --output before.json
+  python frankenusb_bench.py --scenario eight_axes --speed 0
+  python frankenusb_bench.py --replay taxi.rec --config frankenusb-frankensim.conf
+"""
+# pylint: disable=invalid-name
+import argparse
+import asyncio
+import json
+import logging
+import math
+import platform
+import sys
+import threading
+import time
+from frankenusb import FrankenUsb, WIRE_LATENCY_AXES, WIRE_LATENCY_BUTTONS
+from frankenusb_replay import (EventReplayer, ReplayJoystick, read_recording,
+                               FrankenUsbReplayException, RECORD_AXIS,
+                               RECORD_BUTTON_DOWN, RECORD_BUTTON_UP)
+from frankenusb_stats import LatencyHistogram
+from psx_standin import PsxStandIn
+
+BENCH_PORT = 10799
+
+# The devices used in the benchmark, independent of the user's config
+BENCH_STICK = 'BENCH STICK'
+BENCH_THROTTLE = 'BENCH THROTTLE'
+BENCH_CONFIG = {
+    BENCH_STICK: {
+        'axis motion': {
+            # Aileron, also tiller when tiller mode is on
+            0: {'axis type': 'NORMAL', 'psx variable': 'FltControls', 'indexes': [1],
+                'psx min': -999, 'psx max': 999, 'static zones': [(-0.01, 0.01, 0.0)],
+                'tiller': True},
+            # Elevator
+            1: {'axis type': 'NORMAL', 'psx variable': 'FltControls', 'indexes': [0],
+                'psx min': -999, 'psx max': 999, 'static zones': [(-0.01, 0.01, 0.0)]},
+            # Rudder
+            2: {'axis type': 'NORMAL', 'psx variable': 'FltControls', 'indexes': [2],
+                'psx min': -999, 'psx max': 999, 'static zones': [(-0.07, 0.07, 0.0)],
+                'static zone hysteresis': 0.02},
+            # Toe brakes
+            3: {'axis type': 'NORMAL', 'psx variable': 'Brakes', 'indexes': [0],
+                'psx min': 0, 'psx max': 1000},
+            4: {'axis type': 'NORMAL', 'psx variable': 'Brakes', 'indexes': [1],
+                'psx min': 0, 'psx max': 1000},
+            # Tiller
+            5: {'axis type': 'NORMAL', 'psx variable': 'Tiller', 'indexes': [0],
+                'axis swap': True, 'psx min': -999, 'psx max': 999},
+        },
+        'button down': {
+            **{button: {'button type': 'SET', 'psx variable': 'McpTurnSpd', 'value': 1}
+               for button in range(8)},
+            8: {'button type': 'TILLER_TOGGLE'},
+        },
+        'button up': {
+            button: {'button type': 'SET', 'psx variable': 'McpTurnSpd', 'value': 0}
+            for button in range(8)
+        },
+    },
+    BENCH_THROTTLE: {
+        'axis motion': {
+            axis: {'axis type': 'THROTTLE_WITH_REVERSE_BUTTON', 'psx variable': 'Tla',
+                   'axis min': -1.0, 'axis max': 0.62, 'psx idle': 0, 'psx full': 5000,
+                   'psx reverse idle': -3000, 'psx reverse full': -8925,
+                   'reverse lever unlocked range': (-999.0, -0.9),
+                   'engine indexes': [axis]}
+            for axis in range(4)
+        },
+    },
+}
+BENCH_JOYSTICKS = {0: BENCH_STICK, 1: BENCH_THROTTLE}
+
+
+def axis_value(value):
+    """Quantise a value to what pygame can report for an axis."""
+    return round(max(-1.0, min(1.0, value)) * 32767) / 32767
+
+
+def axis_batches(axes, rate_hz, duration):
+    """Make replay batches for axes moving together.
+
+    axes is a list of (instance id, axis, function(t) -> value).
+    """
+    batches = []
+    for sample in range(int(rate_hz * duration)):
+        t = sample / rate_hz
+        batches.append((int(t * 1e9), [(RECORD_AXIS, instance_id, axis, axis_value(function(t)))
+                                       for instance_id, axis, function in axes]))
+    return batches
+
+
+def sweep(t, period=2.0):
+    """Full range triangle wave."""
+    phase = (t / period) % 1.0
+    return 4 * phase - 1 if phase < 0.5 else 3 - 4 * phase
+
+
+def scenario_single_axis_sweep(duration):
+    """One axis moving over its full range."""
+    return axis_batches([(0, 2, sweep)], 1000, duration), {}
+
+
+def scenario_eight_axes(duration):
+    """Aileron, elevator, rudder, both toe brakes and three throttles moving together."""
+    axes = [(0, axis, lambda t, axis=axis: math.sin(2 * math.pi * (t + axis / 8)))
+            for axis in range(5)]
+    axes += [(1, axis, lambda t, axis=axis: sweep(t + axis / 4) * 0.8 - 0.2)
+             for axis in range(3)]
+    return axis_batches(axes, 500, duration), {}
+
+
+def scenario_button_storm(duration):
+    """Eight buttons pressed and released as fast as a human can't."""
+    batches = []
+    rate_hz = 200
+    for sample in range(int(rate_hz * duration)):
+        record_type = RECORD_BUTTON_DOWN if sample % 2 == 0 else RECORD_BUTTON_UP
+        batches.append((int(sample / rate_hz * 1e9),
+                        [(record_type, 0, button, 0.0) for button in range(8)]))
+    return batches, {}
+
+
+def scenario_at_throttle(duration):
+    """Throttles moving while the autothrottle is engaged."""
+    axes = [(1, axis, lambda t, axis=axis: sweep(t + axis / 8) * 0.8 - 0.2) for axis in range(4)]
+    return axis_batches(axes, 500, duration), {'Afds': "13;0;0;0;0;0;0;0;0;0"}
+
+
+def scenario_tiller_toggle(duration):
+    """Tiller mode toggled every 100 ms while the aileron and rudder move."""
+    batches = axis_batches([(0, 0, sweep), (0, 2, lambda t: sweep(t, 1.0))], 500, duration)
+    for index, (_, records) in enumerate(batches):
+        if index % 50 == 0:
+            records.append((RECORD_BUTTON_DOWN, 0, 8, 0.0))
+    return batches, {}
+
+
+def scenario_idle_noise(duration):
+    """Rudder noise inside its static zone, should not reach PSX."""
+    def noise(t):
+        return 0.03 * math.sin(2 * math.pi * 7 * t) + 0.02 * math.sin(2 * math.pi * 13 * t)
+    return axis_batches([(0, 2, noise)], 500, duration), {}
+
+
+def scenario_zone_edge(duration):
+    """Rudder resting on the edge of its static zone."""
+    def noise(t):
+        return 0.07 + 0.01 * math.sin(2 * math.pi * 7 * t) + 0.005 * math.sin(2 * math.pi * 13 * t)
+    return axis_batches([(0, 2, noise)], 500, duration), {}
+
+
+SCENARIOS = {
+    'single_axis_sweep': scenario_single_axis_sweep,
+    'eight_axes': scenario_eight_axes,
+    'button_storm': scenario_button_storm,
+    'at_throttle': scenario_at_throttle,
+    'tiller_toggle': scenario_tiller_toggle,
+    'idle_noise': scenario_idle_noise,
+    'zone_edge': scenario_zone_edge,
+}
+
+
+class StandInThread():  # pylint: disable=too-few-public-methods
+    """A PSX stand-in running on its own event loop in its own thread.
+
+    Keeping it off the frankenusb thread means the CPU time we measure
+    for frankenusb does not include the server.
+    """
+
+    def __init__(self, variables, port):
+        """Start the server."""
+        self.standin = PsxStandIn(variables=variables, logger=logging.getLogger("psx_standin"))
+        self.standin.keep_writes = False
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.standin.start_server(port=port))
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name="psx stand-in", daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def stop(self):
+        """Stop the server."""
+        async def close():
+            self.standin.server.close()
+            for session in list(self.standin.sessions.values()):
+                session.writer.close()
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+async def run_franken(franken, replayer):
+    """Replay the input into franken and wait until everything is sent."""
+    tasks = [asyncio.create_task(franken.setup_psx_connection())]
+    while not franken.psx_connected:
+        await asyncio.sleep(0.01)
+    # Let the stand-in greeting settle
+    await asyncio.sleep(0.1)
+    # The sender backs off for a second if PSX is not connected, so
+    # don't start the pipeline until it is
+    tasks += [asyncio.create_task(coro) for coro in [
+        franken.handle_pygame_events(),
+        franken.psx_axis_sender(),
+    ]]
+    franken.replayer = replayer
+    start = time.monotonic()
+    cpu_start = time.thread_time()
+    await franken.read_pygame_events()
+    while franken.psx_send_heap or franken.psx_axis_queue.qsize() > 0:
+        await asyncio.sleep(0.001)
+    elapsed = time.monotonic() - start
+    cpu = time.thread_time() - cpu_start
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return elapsed, cpu
+
+
+def latency_ms(histogram, percent=None):
+    """Get a percentile (or the max) of a histogram in ms, None if it is empty."""
+    if histogram.count == 0:
+        return None
+    if percent is None:
+        return histogram.max / 1e6
+    return histogram.percentile(percent) / 1e6
+
+
+def run_input(batches, variables, config, joysticks, args):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """Run frankenusb with config on input batches and return the results.
+
+    config is (CONFIG, CONFIG_MISC), joysticks is a dict of instance
+    id -> ReplayJoystick.
+    """
+    standin = StandInThread(variables, args.port)
+    franken = FrankenUsb()
+    franken.logger.setLevel(logging.WARNING)
+    franken._handle_args([  # pylint: disable=protected-access
+        '--psx-host', '127.0.0.1', '--psx-port', str(args.port),
+        '--max-rate', str(args.max_rate), '--quiet',
+        '--adaptive-rate-buffer', str(args.adaptive_rate_buffer),
+    ])
+    franken.config, franken.config_misc = config
+    franken.compile_dispatch()
+    for joystick in joysticks.values():
+        if joystick.get_name() in franken.compiled_config:
+            franken.add_joystick(joystick)
+    replayer = EventReplayer(joysticks, batches, args.speed)
+    try:
+        elapsed, cpu = asyncio.run(run_franken(franken, replayer))
+        # Give the stand-in a moment to read the last writes
+        time.sleep(0.05)
+    finally:
+        standin.stop()
+    events = sum(len(records) for _, records in batches)
+    latency = LatencyHistogram()
+    for key in [WIRE_LATENCY_AXES, WIRE_LATENCY_BUTTONS]:
+        if key in franken.stats.histograms:
+            latency.merge(franken.stats.histograms[key])
+    return {
+        'events': events,
+        'duration_s': elapsed,
+        'events_per_s': events / elapsed,
+        'wire_writes': standin.standin.write_count,
+        'wire_writes_per_s': standin.standin.write_count / elapsed,
+        'latency_p50_ms': latency_ms(latency, 50),
+        'latency_p99_ms': latency_ms(latency, 99),
+        'latency_max_ms': latency_ms(latency),
+        'cpu_us_per_event': cpu / events * 1e6 if events else None,
+        'stats': franken.stats.summary(),
+    }
+
+
+def run_scenario(name, args):
+    """Run one scenario and return the results."""
+    batches, variables = SCENARIOS[name](args.duration)
+    joysticks = {instance_id: ReplayJoystick(instance_id, joystick_name)
+                 for instance_id, joystick_name in BENCH_JOYSTICKS.items()}
+    return run_input(batches, variables, (BENCH_CONFIG, {}), joysticks, args)
+
+
+def run_replay(args):
+    """Run a recording with the config it was recorded with and return the results."""
+    try:
+        joysticks, batches = read_recording(args.replay)
+    except (IOError, FrankenUsbReplayException) as inst:
+        raise SystemExit(f"Failed to read {args.replay}: {inst}") from inst
+    loader = FrankenUsb()
+    try:
+        module = loader.load_module_from_file("config", args.config)
+    except IOError as inst:
+        raise SystemExit(f"Failed to open config file {args.config}: {inst}") from inst
+    config = (module.CONFIG, getattr(module, 'CONFIG_MISC', {}))
+    return run_input(batches, {}, config, joysticks, args)
+
+
+def handle_args():
+    """Handle command line arguments."""
+    parser = argparse.ArgumentParser(
+        prog='frankenusb_bench',
+        description='Benchmark the frankenusb pipeline against a local PSX stand-in')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                        help='scenario to run (can be repeated, default all)')
+    parser.add_argument('--replay', action='store', metavar='FILE',
+                        help='run a recording made with frankenusb --record instead of '
+                        'the scenarios')
+    parser.add_argument('--config', action='store', default="frankenusb-frankensim.conf",
+                        help='frankenusb config file the --replay recording was made with')
+    parser.add_argument('--duration', action='store', default=2.0, type=float,
+                        help='length of each synthetic scenario (s)')
+    parser.add_argument('--speed', action='store', default=1.0, type=float,
+                        help='input speed relative to real time (0 = as fast as possible)')
+    parser.add_argument('--max-rate', action='store', default=20.0, type=float,
+                        help='frankenusb --max-rate')
+    parser.add_argument('--adaptive-rate-buffer', action='store', default=0, type=int,
+                        help='frankenusb --adaptive-rate-buffer')
+    parser.add_argument('--port', action='store', default=BENCH_PORT, type=int,
+                        help='port for the PSX stand-in')
+    parser.add_argument('--output', action='store', metavar='FILE',
+                        help='write JSON results to FILE instead of stdout')
+    return parser.parse_args()
+
+
+def main():
+    """Run the benchmarks."""
+    args = handle_args()
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.WARNING,
+                        datefmt="%H:%M:%S")
+    results = {
+        'python': sys.version,
+        'platform': platform.platform(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'settings': {
+            'duration': args.duration,
+            'speed': args.speed,
+            'max_rate': args.max_rate,
+            'adaptive_rate_buffer': args.adaptive_rate_buffer,
+        },
+        'scenarios': {},
+    }
+    if args.replay:
+        print(f"Replaying {args.replay}", file=sys.stderr)
+        results['settings']['config'] = args.config
+        results['scenarios'][f"replay {args.replay}"] = run_replay(args)
+    for name in args.scenario or ([] if args.replay else list(SCENARIOS)):
+        print(f"Running {name}", file=sys.stderr)
+        results['scenarios'][name] = run_scenario(name, args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+"""Compile the frankenusb CONFIG into per-axis and per-button handlers.
+
+The config file is written for humans: nested dicts with optional
+keys and string axis/button types. Looking all of that up on every
+pygame event is wasteful, so when the config is loaded we turn each
+configured axis and button into a small object with everything
+resolved up front (handler to call, normalisation constants, PSX
+ranges, flags) and a lookup table from axis value to PSX value.
+"""
+# pylint: disable=too-few-public-methods
+from array import array
+from frankenusb_filters import make_filter_chain, FrankenUsbFilterException
+from frankenusb_curves import make_curve, make_calibration, FrankenUsbCurveException
+
+# pygame axes are always -1 .. +1
+AXIS_MIN = -1.0
+AXIS_MAX = 1.0
+
+# The axis value -> PSX value lookup tables have one entry per SDL
+# axis step. pygame reports the raw SDL value (-32768..32767) divided
+# by 32767, so the table entries are exactly the values we can get.
+LUT_SCALE = 32767
+LUT_OFFSET = 32768
+LUT_SIZE = 65536
+
+# The PSX range used for an axis in tiller mode
+TILLER_PSX_MIN = -999
+TILLER_PSX_MAX = 999
+
+
+def lut_index(value):
+    """Get the lookup table index for a pygame axis value."""
+    index = round(value * LUT_SCALE) + LUT_OFFSET
+    if index < 0:
+        return 0
+    if index >= LUT_SIZE:
+        return LUT_SIZE - 1
+    return index
+
+
+def make_table(function):
+    """Make a lookup table of function(axis value) for all axis values."""
+    return array('i', (function(max(AXIS_MIN, (index - LUT_OFFSET) / LUT_SCALE))
+                       for index in range(LUT_SIZE)))
+
+
+class FrankenUsbConfigException(Exception):
+    """FrankenUSB config exception.
+
+    Raised when the config file contains something we cannot handle.
+    """
+
+
+class CompiledAxis():  # pylint: disable=too-many-instance-attributes
+    """Precomputed settings for one configured axis."""
+
+    __slots__ = (
+        'joystick_name', 'axis', 'name', 'axis_type', 'handler', 'psx_variable', 'indexes',
+        'static_zones', 'swap', 'axis_min', 'axis_range', 'psx_min', 'psx_range',
+        'tiller', 'psx_lo', 'psx_hi', 'psx_reverse_min', 'psx_reverse_range',
+        'psx_reverse_lo', 'psx_reverse_hi', 'reverse_unlocked_range',
+        'limit_stowed', 'limit_armed', 'limit_flight_upper',
+        'table', 'tiller_table', 'reverse_table', 'filter_configs', 'zone_hysteresis',
+        'curve', 'calibration',
+    )
+
+    def __init__(self, joystick_name, axis, axis_config, handler, calibration=None):
+        """Resolve everything we need from the axis config.
+
+        calibration is the calibration profile for the axis, if any.
+        """
+        self.joystick_name = joystick_name
+        self.axis = axis
+        # Used in logs and statistics
+        self.name = f"{joystick_name}/{axis}"
+        self.axis_type = axis_config['axis type']
+        self.handler = handler
+        self.psx_variable = axis_config['psx variable']
+        # Calibration, static zones and curves are not used on
+        # SPEEDBRAKE axes, their stowed/armed/flight limits are set on
+        # the raw axis position
+        shaped = self.axis_type != 'SPEEDBRAKE'
+        # (axis min, axis max, replacement value, hysteresis), the
+        # hysteresis defaults to 'static zone hysteresis' for the axis
+        hysteresis = axis_config.get('static zone hysteresis', 0.0)
+        self.static_zones = tuple((zone[0], zone[1], zone[2],
+                                   zone[3] if len(zone) > 3 else hysteresis)
+                                  for zone in axis_config.get('static zones', ()) if shaped)
+        # Zones with hysteresis need to know where the axis was, so
+        # they are applied per event and left out of the tables
+        self.zone_hysteresis = any(zone[3] > 0 for zone in self.static_zones)
+        self.swap = axis_config.get('axis swap', False) is True
+        # Only throttles can have a narrower axis range, other axes use all of it
+        limits = axis_config if self.axis_type == 'THROTTLE_WITH_REVERSE_BUTTON' else {}
+        self.axis_min = limits.get('axis min', AXIS_MIN)
+        self.axis_range = limits.get('axis max', AXIS_MAX) - self.axis_min
+        self.tiller = axis_config.get('tiller', False) is True
+        self.limit_stowed = axis_config.get('limit stowed')
+        self.limit_armed = axis_config.get('limit armed')
+        self.limit_flight_upper = axis_config.get('limit flight upper')
+        self.reverse_unlocked_range = axis_config.get('reverse lever unlocked range')
+        self.filter_configs = tuple(axis_config.get('filters', ()))
+        # Functions folded into the lookup tables, see frankenusb_curves.py
+        self.curve = (make_curve(axis_config['curve'])
+                      if shaped and 'curve' in axis_config else None)
+        self.calibration = make_calibration(calibration) if shaped and calibration else None
+        if self.axis_type == 'THROTTLE_WITH_REVERSE_BUTTON':
+            self.indexes = axis_config['engine indexes']
+            self.psx_min = axis_config['psx idle']
+            self.psx_range = axis_config['psx full'] - self.psx_min
+            self.psx_reverse_min = axis_config['psx reverse idle']
+            self.psx_reverse_range = axis_config['psx reverse full'] - self.psx_reverse_min
+            self.psx_reverse_lo = min(axis_config['psx reverse idle'],
+                                      axis_config['psx reverse full'])
+            self.psx_reverse_hi = max(axis_config['psx reverse idle'],
+                                      axis_config['psx reverse full'])
+        else:
+            if self.axis_type == 'NORMAL' and not {'psx min', 'psx max'} <= axis_config.keys():
+                raise FrankenUsbConfigException(
+                    f"{joystick_name}: axis {axis}: NORMAL axis needs psx min and psx max")
+            self.indexes = axis_config.get('indexes', [0])
+            self.psx_min = axis_config.get('psx min')
+            self.psx_range = (axis_config['psx max'] - self.psx_min
+                              if 'psx max' in axis_config else None)
+            # Only throttles have a reverse range
+            self.psx_reverse_min = self.psx_reverse_range = None
+            self.psx_reverse_lo = self.psx_reverse_hi = None
+        if self.psx_range is not None:
+            self.psx_lo = min(self.psx_min, self.psx_min + self.psx_range)
+            self.psx_hi = max(self.psx_min, self.psx_min + self.psx_range)
+        else:
+            self.psx_lo = None
+            self.psx_hi = None
+        self.table = None
+        self.tiller_table = None
+        self.reverse_table = None
+        self.build_tables()
+
+    def build_tables(self):
+        """Build the axis value -> PSX value lookup tables.
+
+        The whole chain (calibration, static zones, swap, normalize,
+        curve, scale, clamp) is run once per table entry here, so
+        mapping an axis event is a single index operation regardless
+        of config. Calibration and static zones on axes with zone
+        hysteresis are the exception, see static_zone().
+        """
+        if self.axis_type == 'THROTTLE_WITH_REVERSE_BUTTON':
+            self.table = make_table(lambda value: self.throttle_value(self.normalize(value), False))
+            self.reverse_table = make_table(
+                lambda value: self.throttle_value(self.normalize(value), True))
+        elif self.axis_type == 'NORMAL':
+            self.table = make_table(lambda value: self.psx_value(self.normalize(value)))
+            if self.tiller:
+                self.tiller_table = make_table(
+                    lambda value: self.tiller_value(self.normalize(value)))
+
+    def make_filters(self):
+        """Make a new FilterChain for this axis, or None if it has no filters.
+
+        Each open joystick gets its own chain, so filter state is
+        never shared between devices and starts fresh on reconnect.
+        """
+        if not self.filter_configs:
+            return None
+        return make_filter_chain(self.filter_configs)
+
+    def static_zone(self, value, zone):
+        """Apply calibration and static zones with hysteresis to an axis value.
+
+        zone is the index of the static zone the axis was in, or -1.
+        The axis enters a zone between its axis min and max, but only
+        leaves it when it moves more than the hysteresis outside.
+
+        Returns (value, zone, held) where held is True if the axis is
+        only in the zone because of the hysteresis.
+        """
+        if self.calibration is not None:
+            value = self.calibration(value)
+        if zone >= 0:
+            low, high, replacement, hysteresis = self.static_zones[zone]
+            if low - hysteresis <= value <= high + hysteresis:
+                return replacement, zone, not low <= value <= high
+        for index, (low, high, replacement, _) in enumerate(self.static_zones):
+            if low <= value <= high:
+                return replacement, index, False
+        return value, -1, False
+
+    def normalize(self, value):
+        """Apply calibration, static zones, swap and curve, and normalize the axis value to 0..1."""
+        if not self.zone_hysteresis:
+            if self.calibration is not None:
+                value = self.calibration(value)
+            for zone in self.static_zones:
+                if zone[0] <= value <= zone[1]:
+                    value = zone[2]
+        if self.swap:
+            value = -value
+        normalized = (value - self.axis_min) / self.axis_range
+        if self.curve is not None:
+            normalized = self.curve(normalized)
+        return normalized
+
+    def psx_value(self, normalized):
+        """Convert a normalized axis value to the PSX value."""
+        return int(self.psx_min + self.psx_range * normalized)
+
+    def tiller_value(self, normalized):
+        """Convert a normalized axis value to the PSX tiller value."""
+        return int(TILLER_PSX_MIN + (TILLER_PSX_MAX - TILLER_PSX_MIN) * normalized)
+
+    def throttle_value(self, normalized, reverse):
+        """Convert a normalized axis value to a PSX thrust lever value.
+
+        Never returns a value outside the expected range.
+        """
+        if reverse:
+            psx_value = int(self.psx_reverse_min + self.psx_reverse_range * normalized)
+            return min(self.psx_reverse_hi, max(self.psx_reverse_lo, psx_value))
+        psx_value = int(self.psx_min + self.psx_range * normalized)
+        return min(self.psx_hi, max(self.psx_lo, psx_value))
+
+
+class CompiledButton():  # pylint: disable=too-many-instance-attributes
+    """Precomputed settings for one configured button and direction."""
+
+    __slots__ = (
+        'joystick_name', 'button', 'direction', 'button_type', 'handler', 'psx_variable',
+        'value', 'increment', 'min', 'max', 'wrap', 'axis', 'axis_config',
+    )
+
+    def __init__(self, joystick_name, button, direction, button_config, handler):
+        """Resolve everything we need from the button config."""
+        self.joystick_name = joystick_name
+        self.button = button
+        self.direction = direction
+        self.button_type = button_config['button type']
+        self.handler = handler
+        self.psx_variable = button_config.get('psx variable')
+        self.value = button_config.get('value')
+        self.increment = button_config.get('increment')
+        if self.increment is not None:
+            self.increment = int(self.increment)
+        self.min = button_config.get('min')
+        self.max = button_config.get('max')
+        self.wrap = button_config.get('wrap', False) is True
+        self.axis = button_config.get('axis')
+        # Filled in by compile_device() for REVERSE_LEVER buttons
+        self.axis_config = None
+
+
+class CompiledDevice():
+    """All compiled axes and buttons for one joystick name."""
+
+    __slots__ = ('joystick_name', 'axes', 'buttons')
+
+    def __init__(self, joystick_name):
+        """Initialize an empty device."""
+        self.joystick_name = joystick_name
+        # axis -> CompiledAxis
+        self.axes = {}
+        # (button, direction) -> CompiledButton
+        self.buttons = {}
+
+
+def compile_device(joystick_name, device_config, axis_handlers, button_handlers,
+                   calibration=None):
+    """Compile the config for one joystick.
+
+    calibration is a dict of axis -> calibration profile.
+    """
+    device = CompiledDevice(joystick_name)
+    calibration = calibration or {}
+    for axis, axis_config in device_config.get('axis motion', {}).items():
+        try:
+            handler = axis_handlers[axis_config['axis type']]
+        except KeyError as exc:
+            raise FrankenUsbConfigException(
+                f"{joystick_name}: unknown axis type {axis_config['axis type']}") from exc
+        try:
+            device.axes[axis] = CompiledAxis(joystick_name, axis, axis_config, handler,
+                                             calibration.get(axis))
+            device.axes[axis].make_filters()
+        except (FrankenUsbFilterException, FrankenUsbCurveException) as exc:
+            raise FrankenUsbConfigException(f"{joystick_name}: axis {axis}: {exc}") from exc
+    for direction in ['up', 'down']:
+        for button, button_config in device_config.get(f"button {direction}", {}).items():
+            try:
+                handler = button_handlers[button_config['button type']]
+            except KeyError as exc:
+                raise FrankenUsbConfigException(
+                    f"{joystick_name}: unknown button type {button_config['button type']}"
+                ) from exc
+            compiled = CompiledButton(joystick_name, button, direction, button_config, handler)
+            if compiled.axis is not None:
+                try:
+                    compiled.axis_config = device.axes[compiled.axis]
+                except KeyError as exc:
+                    raise FrankenUsbConfigException(
+                        f"{joystick_name}: button {button} refers to unconfigured axis "
+                        f"{compiled.axis}") from exc
+            device.buttons[(button, direction)] = compiled
+    return device
+
+
+def compile_config(config, axis_handlers, button_handlers, calibration=None):
+    """Compile CONFIG into a dict of joystick name -> CompiledDevice.
+
+    axis_handlers and button_handlers map the 'axis type' and
+    'button type' strings to the function that handles that type.
+    calibration is CALIBRATION from the calibration file, if any.
+    """
+    calibration = calibration or {}
+    return {
+        joystick_name: compile_device(joystick_name, device_config,
+                                      axis_handlers, button_handlers,
+                                      calibration.get(joystick_name))
+        for joystick_name, device_config in config.items()
+    }
@@ -0,0 +1,185 @@
+"""Response curves and calibration for frankenusb axes.
+
+Both are folded into the axis lookup tables when the config is
+compiled, so they cost nothing per event.
+
+A response curve is set per axis in CONFIG, and works on the axis
+value after static zones and swap, scaled to 0..1:
+
+'curve': {'curve type': 'EXPONENTIAL', 'exponent': 2.0, 'centred': True},
+'curve': {'curve type': 'S_CURVE', 'strength': 0.5},
+'curve': {'curve type': 'POINTS', 'points': [(0.0, 0.0), (0.5, 0.3), (1.0, 1.0)]},
+
+EXPONENTIAL: value ** 'exponent' (default 2.0), more than 1 gives
+  finer control near 0.
+S_CURVE: a blend, by 'strength' (0..1, default 0.5), of the linear
+  value and a smoothstep, i.e less sensitive at both ends.
+POINTS: piecewise linear through a list of (in, out) points, in must
+  be increasing.
+With 'centred': True the curve is applied to the deflection from the
+centre in both directions instead, e.g for rudder and aileron.
+
+A calibration profile maps the raw range an axis actually reports to
+-1..1, with an optional centre. Profiles are kept per device name in
+a calibration file:
+
+CALIBRATION = {
+    'MFG Crosswind V2': {
+        2: {'min': -0.981, 'centre': 0.012, 'max': 0.975},
+    },
+}
+
+frankenusb --calibrate learns them: move every axis to both ends,
+with centred axes at rest when starting up.
+
+Curves and calibration are not used on SPEEDBRAKE axes, as their
+'limit stowed', 'limit armed' and 'limit flight upper' are set on the
+axis position as it is.
+"""
+# pylint: disable=too-few-public-methods
+import pprint
+import time
+
+# An axis must move at least this much before we write a calibration for it
+CALIBRATION_MIN_RANGE = 0.1
+
+
+class FrankenUsbCurveException(Exception):
+    """FrankenUSB curve exception.
+
+    Raised when a curve or calibration has an unknown type or bad
+    settings.
+    """
+
+
+def exponential_curve(curve_config):
+    """Make an EXPONENTIAL curve."""
+    exponent = curve_config.get('exponent', 2.0)
+    if exponent <= 0:
+        raise FrankenUsbCurveException(f"EXPONENTIAL exponent must be positive, not {exponent}")
+    return lambda value: value ** exponent
+
+
+def s_curve(curve_config):
+    """Make an S_CURVE curve."""
+    strength = curve_config.get('strength', 0.5)
+    if not 0.0 <= strength <= 1.0:
+        raise FrankenUsbCurveException(f"S_CURVE strength must be in 0..1, not {strength}")
+    return lambda value: value + strength * (value * value * (3 - 2 * value) - value)
+
+
+def points_curve(curve_config):
+    """Make a POINTS curve."""
+    points = [tuple(point) for point in curve_config.get('points', [])]
+    if len(points) < 2:
+        raise FrankenUsbCurveException("POINTS needs at least two points")
+    if any(point[0] >= next_point[0] for point, next_point in zip(points, points[1:])):
+        raise FrankenUsbCurveException("POINTS must have increasing in values")
+
+    def curve(value):
+        if value <= points[0][0]:
+            return points[0][1]
+        for (in_low, out_low), (in_high, out_high) in zip(points, points[1:]):
+            if value <= in_high:
+                return out_low + (out_high - out_low) * (value - in_low) / (in_high - in_low)
+        return points[-1][1]
+
+    return curve
+
+
+CURVE_TYPES = {
+    'EXPONENTIAL': exponential_curve,
+    'S_CURVE': s_curve,
+    'POINTS': points_curve,
+}
+
+
+def make_curve(curve_config):
+    """Make a function 0..1 -> 0..1 from the 'curve' of an axis config."""
+    curve_type = curve_config.get('curve type')
+    try:
+        curve = CURVE_TYPES[curve_type](curve_config)
+    except KeyError as exc:
+        raise FrankenUsbCurveException(f"unknown curve type {curve_type}") from exc
+    if not curve_config.get('centred', False):
+        return lambda value: curve(min(1.0, max(0.0, value)))
+
+    def centred(value):
+        deflection = min(1.0, max(-1.0, 2 * value - 1))
+        if deflection < 0:
+            return (1 - curve(-deflection)) / 2
+        return (1 + curve(deflection)) / 2
+
+    return centred
+
+
+def make_calibration(profile):
+    """Make a function raw axis value -> -1..1 from a calibration profile."""
+    try:
+        low = profile['min']
+        high = profile['max']
+    except KeyError as exc:
+        raise FrankenUsbCurveException(f"calibration needs min and max, not {profile}") from exc
+    centre = profile.get('centre')
+    if centre is None:
+        centre = (low + high) / 2
+    if not low < centre < high:
+        raise FrankenUsbCurveException(f"calibration needs min < centre < max, not {profile}")
+
+    def calibrate(value):
+        if value < centre:
+            value = (value - centre) / (centre - low)
+        else:
+            value = (value - centre) / (high - centre)
+        return min(1.0, max(-1.0, value))
+
+    return calibrate
+
+
+class CalibrationLearner():
+    """Learn calibration profiles from the axis values we see."""
+
+    def __init__(self, profiles):
+        """Start learning, on top of the profiles we already have."""
+        self.profiles = profiles
+        # (joystick name, axis) -> [min, first value (at rest), max]
+        self.seen = {}
+        self.changed = False
+
+    def record(self, joystick_name, axis, value):
+        """Record a raw axis value."""
+        seen = self.seen.get((joystick_name, axis))
+        if seen is None:
+            self.seen[(joystick_name, axis)] = [value, value, value]
+            return
+        if value < seen[0]:
+            seen[0] = value
+            self.changed = True
+        elif value > seen[2]:
+            seen[2] = value
+            self.changed = True
+
+    def learned(self):
+        """Get the profiles, with what we have learned so far.
+
+        The first value seen for an axis is only used as the centre
+        if it is near the middle of the range, i.e the axis was at
+        rest in the centre when we started.
+        """
+        profiles = {name: dict(axes) for name, axes in self.profiles.items()}
+        for (joystick_name, axis), (low, first, high) in sorted(self.seen.items()):
+            if high - low < CALIBRATION_MIN_RANGE:
+                continue
+            profile = {'min': round(low, 4), 'max': round(high, 4)}
+            if low + (high - low) / 4 < first < high - (high - low) / 4:
+                profile['centre'] = round(first, 4)
+            profiles.setdefault(joystick_name, {})[axis] = profile
+        return profiles
+
+    def write(self, path):
+        """Write the profiles to a calibration file."""
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write("# -*- mode: Python;-*-\n")
+            file.write(f"# Written by frankenusb --calibrate {time.strftime('%Y-%m-%d %H:%M')}\n")
+            file.write(f"CALIBRATION = {pprint.pformat(self.learned())}\n")
+        self.changed = False
@@ -0,0 +1,233 @@
+"""Per-axis signal filters for frankenusb.
+
+Configured per axis in CONFIG as a list of filters that are run in
+order on the pygame axis value before it is mapped to a PSX value,
+e.g for a noisy toe brake:
+
+'filters': [
+    {'filter type': 'MEDIAN', 'size': 5},
+    {'filter type': 'EMA', 'alpha': 0.3},
+],
+
+EMA: exponential moving average. 'alpha' (0..1, default 0.5), lower
+  is smoother but lags more.
+ONE_EURO: the 1 euro filter (Casiez, Roussel and Vogel, CHI 2012).
+  Smooths hard when the axis moves slowly and hardly at all when it
+  moves fast, good for rudder and aileron. 'min cutoff' (Hz, default
+  1.0), lower is smoother at rest. 'beta' (default 0.5), higher gives
+  less lag on fast moves. 'd cutoff' (Hz, default 1.0) is used to
+  smooth the speed estimate.
+MEDIAN: median of the last 'size' (default 3) values, removes spikes.
+RATE_LIMIT: the value never changes faster than 'max rate' (axis
+  units/s, the full axis range is 2.0).
+
+Each filter keeps its state in a small array allocated when the
+joystick is opened.
+"""
+# pylint: disable=too-few-public-methods
+import bisect
+import math
+from array import array
+
+# If two events have the same timestamp, use this as the time between them (s)
+MIN_DT = 0.001
+
+
+class FrankenUsbFilterException(Exception):
+    """FrankenUSB filter exception.
+
+    Raised when a filter has an unknown type or bad settings.
+    """
+
+
+class EmaFilter():
+    """Exponential moving average."""
+
+    __slots__ = ('alpha', 'state')
+
+    def __init__(self, alpha):
+        """Initialize the filter."""
+        if not 0.0 < alpha <= 1.0:
+            raise FrankenUsbFilterException(f"EMA alpha must be in (0, 1], not {alpha}")
+        self.alpha = alpha
+        # Last output, 1.0 if we have one
+        self.state = array('d', [0.0, 0.0])
+
+    @classmethod
+    def from_config(cls, filter_config):
+        """Make a filter from its config."""
+        return cls(filter_config.get('alpha', 0.5))
+
+    def process(self, value, _):
+        """Filter a value."""
+        state = self.state
+        if state[1]:
+            value = state[0] + self.alpha * (value - state[0])
+        else:
+            state[1] = 1.0
+        state[0] = value
+        return value
+
+
+def smoothing_factor(dt, cutoff):
+    """Get the EMA alpha for a low pass filter with cutoff (Hz) at a sample interval of dt."""
+    tau = 2 * math.pi * cutoff * dt
+    return tau / (tau + 1)
+
+
+class OneEuroFilter():
+    """The 1 euro filter, a low pass filter with a cutoff that rises with speed."""
+
+    __slots__ = ('min_cutoff', 'beta', 'd_cutoff', 'state')
+
+    def __init__(self, min_cutoff, beta, d_cutoff):
+        """Initialize the filter."""
+        if min_cutoff <= 0 or d_cutoff <= 0 or beta < 0:
+            raise FrankenUsbFilterException(
+                "ONE_EURO cutoffs must be positive and beta must not be negative")
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        # Last output, last speed, last time (s), 1.0 if we have them
+        self.state = array('d', [0.0, 0.0, 0.0, 0.0])
+
+    @classmethod
+    def from_config(cls, filter_config):
+        """Make a filter from its config."""
+        return cls(filter_config.get('min cutoff', 1.0), filter_config.get('beta', 0.5),
+                   filter_config.get('d cutoff', 1.0))
+
+    def process(self, value, t):
+        """Filter a value read at time t (s)."""
+        state = self.state
+        if not state[3]:
+            state[0] = value
+            state[1] = 0.0
+            state[2] = t
+            state[3] = 1.0
+            return value
+        dt = t - state[2]
+        if dt <= 0:
+            dt = MIN_DT
+        speed = (value - state[0]) / dt
+        speed = state[1] + smoothing_factor(dt, self.d_cutoff) * (speed - state[1])
+        cutoff = self.min_cutoff + self.beta * abs(speed)
+        value = state[0] + smoothing_factor(dt, cutoff) * (value - state[0])
+        state[0] = value
+        state[1] = speed
+        state[2] = t
+        return value
+
+
+class MedianFilter():
+    """Median of the last N values.
+
+    The last N values are also kept in sorted order, so each new value
+    is a binary search and a list insert/delete instead of a sort.
+    """
+
+    __slots__ = ('values', 'ordered', 'state')
+
+    def __init__(self, size):
+        """Initialize the filter."""
+        if size < 1:
+            raise FrankenUsbFilterException(f"MEDIAN size must be at least 1, not {size}")
+        self.values = array('d', [0.0] * size)
+        # The values we have, sorted
+        self.ordered = []
+        # Next position in values, number of values we have
+        self.state = array('i', [0, 0])
+
+    @classmethod
+    def from_config(cls, filter_config):
+        """Make a filter from its config."""
+        return cls(int(filter_config.get('size', 3)))
+
+    def process(self, value, _):
+        """Filter a value."""
+        values = self.values
+        ordered = self.ordered
+        state = self.state
+        if state[1] < len(values):
+            state[1] += 1
+        else:
+            # Drop the value we overwrite
+            del ordered[bisect.bisect_left(ordered, values[state[0]])]
+        bisect.insort(ordered, value)
+        values[state[0]] = value
+        state[0] = (state[0] + 1) % len(values)
+        middle = state[1] // 2
+        if state[1] % 2:
+            return ordered[middle]
+        return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+class RateLimitFilter():
+    """Limit how fast the value can change."""
+
+    __slots__ = ('max_rate', 'state')
+
+    def __init__(self, max_rate):
+        """Initialize the filter."""
+        if max_rate <= 0:
+            raise FrankenUsbFilterException(f"RATE_LIMIT max rate must be positive, not {max_rate}")
+        self.max_rate = max_rate
+        # Last output, last time (s), 1.0 if we have them
+        self.state = array('d', [0.0, 0.0, 0.0])
+
+    @classmethod
+    def from_config(cls, filter_config):
+        """Make a filter from its config."""
+        try:
+            return cls(filter_config['max rate'])
+        except KeyError as exc:
+            raise FrankenUsbFilterException("RATE_LIMIT needs a 'max rate'") from exc
+
+    def process(self, value, t):
+        """Filter a value read at time t (s)."""
+        state = self.state
+        if state[2]:
+            max_step = self.max_rate * max(t - state[1], 0.0)
+            value = min(state[0] + max_step, max(state[0] - max_step, value))
+        else:
+            state[2] = 1.0
+        state[0] = value
+        state[1] = t
+        return value
+
+
+FILTER_TYPES = {
+    'EMA': EmaFilter,
+    'ONE_EURO': OneEuroFilter,
+    'MEDIAN': MedianFilter,
+    'RATE_LIMIT': RateLimitFilter,
+}
+
+
+class FilterChain():
+    """A list of filters run in order."""
+
+    __slots__ = ('filters',)
+
+    def __init__(self, filters):
+        """Initialize the chain."""
+        self.filters = tuple(filters)
+
+    def process(self, value, t):
+        """Run value, read at time t (s), through all filters."""
+        for axis_filter in self.filters:
+            value = axis_filter.process(value, t)
+        return value
+
+
+def make_filter_chain(filter_configs):
+    """Make a FilterChain from the 'filters' list of an axis config."""
+    filters = []
+    for filter_config in filter_configs:
+        filter_type = filter_config.get('filter type')
+        try:
+            filter_class = FILTER_TYPES[filter_type]
+        except KeyError as exc:
+            raise FrankenUsbFilterException(f"unknown filter type {filter_type}") from exc
+        filters.append(filter_class.from_config(filter_config))
+    return FilterChain(filters)
@@ -0,0 +1,87 @@
+"""Logging for frankenusb that stays out of the way of control inputs.
+
+frankenusb does everything on one asyncio loop, so time spent
+formatting log messages and writing them to the console is time
+not spent on axis events. With start_queue_logging() a log call just
+puts the record in a queue, and a QueueListener thread formats and
+writes it.
+
+Log sites that run for every axis event use a RateLimitedLogger, so
+--debug shows a sample of what is going on instead of every event.
+"""
+import logging
+import logging.handlers
+import queue
+import time
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that leaves all formatting to the listener thread.
+
+    The standard prepare() formats the message before queueing it,
+    which is the work we want off the event loop. The queue never
+    leaves this process, so the record can go as it is, as long as
+    log arguments are not changed after the log call.
+    """
+
+    def prepare(self, record):
+        """Queue the record as it is."""
+        return record
+
+
+def start_queue_logging():
+    """Send all log records through a queue to the handlers we have now.
+
+    Call after logging.basicConfig(). Returns the started
+    QueueListener, stop() it on exit to flush the queue.
+    """
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    root.addHandler(DeferredQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class RateLimitedLogger():
+    """Log each message at most once per interval."""
+
+    def __init__(self, logger, interval):
+        """Initialize, interval is in seconds."""
+        self.logger = logger
+        self.interval_ns = int(interval * 1e9)
+        # Message format -> [time we can log it again, times suppressed since]
+        self.state = {}
+
+    def log(self, level, msg, *args):
+        """Log msg % args, unless msg was logged less than interval ago."""
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic_ns()
+        state = self.state.get(msg)
+        if state is None:
+            state = self.state[msg] = [0, 0]
+        if now < state[0]:
+            state[1] += 1
+            return
+        if state[1]:
+            msg += " (and %d more like this)"
+            args += (state[1],)
+        state[0] = now + self.interval_ns
+        state[1] = 0
+        self.logger.log(level, msg, *args)
+
+    def debug(self, msg, *args):
+        """Log a rate limited message at DEBUG level."""
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        """Log a rate limited message at INFO level."""
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        """Log a rate limited message at WARNING level."""
+        self.log(logging.WARNING, msg, *args)
@@ -0,0 +1,216 @@
+"""Record and replay joystick event streams for frankenusb.
+
+A recording is a small binary file:
+
+  b"FUSBREC1"
+  then a sequence of records, each starting with a one byte type:
+
+  DEVICE (0): instance id (int32), name length (uint16), name (utf-8)
+  AXIS (1), BUTTON DOWN (2), BUTTON UP (3):
+      time since start of recording (uint64, ns), instance id (int32),
+      axis/button number (uint16), axis value (float32, 0 for buttons)
+
+A DEVICE record is written the first time an instance id is seen.
+Events read from pygame at the same time share a timestamp, and are
+replayed together so coalescing behaves as when recorded.
+
+Replaying feeds the events to FrankenUsb instead of pygame, with fake
+joysticks standing in for the recorded devices, so no controllers are
+needed.
+"""
+import asyncio
+import struct
+import time
+import pygame  # pylint: disable=import-error
+
+MAGIC = b"FUSBREC1"
+
+RECORD_DEVICE = 0
+RECORD_AXIS = 1
+RECORD_BUTTON_DOWN = 2
+RECORD_BUTTON_UP = 3
+
+DEVICE_STRUCT = struct.Struct('<iH')
+EVENT_STRUCT = struct.Struct('<QiHf')
+
+
+class FrankenUsbReplayException(Exception):
+    """FrankenUSB replay exception.
+
+    Raised when a recording cannot be read.
+    """
+
+
+class EventRecorder():
+    """Write pygame joystick events to a recording."""
+
+    def __init__(self, path):
+        """Open the recording for writing."""
+        self.file = open(path, 'wb')  # pylint: disable=consider-using-with
+        self.file.write(MAGIC)
+        self.start = time.monotonic_ns()
+        self.devices = set()
+
+    def record(self, events, t_read, get_name):
+        """Record events read at t_read.
+
+        get_name(instance_id) returns the device name, or '' if we
+        don't know it.
+        """
+        record_type = {
+            pygame.JOYAXISMOTION: RECORD_AXIS,  # pylint: disable=no-member
+            pygame.JOYBUTTONDOWN: RECORD_BUTTON_DOWN,  # pylint: disable=no-member
+            pygame.JOYBUTTONUP: RECORD_BUTTON_UP,  # pylint: disable=no-member
+        }
+        data = []
+        for event in events:
+            if event.type not in record_type:
+                continue
+            if event.instance_id not in self.devices:
+                self.devices.add(event.instance_id)
+                name = get_name(event.instance_id).encode()
+                data.append(bytes([RECORD_DEVICE]))
+                data.append(DEVICE_STRUCT.pack(event.instance_id, len(name)))
+                data.append(name)
+            if event.type == pygame.JOYAXISMOTION:  # pylint: disable=no-member
+                number, value = event.axis, event.value
+            else:
+                number, value = event.button, 0.0
+            data.append(bytes([record_type[event.type]]))
+            data.append(EVENT_STRUCT.pack(t_read - self.start, event.instance_id, number, value))
+        if data:
+            self.file.write(b''.join(data))
+            self.file.flush()
+
+    def close(self):
+        """Close the recording."""
+        self.file.close()
+
+
+class ReplayJoystick():
+    """Stands in for a pygame joystick during replay, or for one read by the input process."""
+
+    def __init__(self, instance_id, name):
+        """Initialize with all axes centred and all buttons released."""
+        self.instance_id = instance_id
+        self.name = name
+        self.axes = {}
+        self.buttons = {}
+
+    def init(self):
+        """Do nothing, for compatibility with pygame joysticks."""
+
+    def quit(self):
+        """Do nothing, for compatibility with pygame joysticks."""
+
+    def get_name(self):
+        """Get the recorded device name."""
+        return self.name
+
+    def get_instance_id(self):
+        """Get the recorded instance id."""
+        return self.instance_id
+
+    def get_axis(self, axis):
+        """Get the last replayed position of an axis."""
+        return self.axes.get(axis, 0.0)
+
+    def get_button(self, button):
+        """Get the last replayed state of a button."""
+        return self.buttons.get(button, 0)
+
+
+def read_recording(path):
+    """Read a recording.
+
+    Returns (joysticks, batches) where joysticks is a dict of
+    instance id -> ReplayJoystick and batches is a list of (time,
+    [(record type, instance id, number, value), ...]) with events
+    that were read together.
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    if not data.startswith(MAGIC):
+        raise FrankenUsbReplayException(f"{path} is not a frankenusb recording")
+    joysticks = {}
+    batches = []
+    pos = len(MAGIC)
+    try:
+        while pos < len(data):
+            record_type = data[pos]
+            pos += 1
+            if record_type == RECORD_DEVICE:
+                instance_id, name_length = DEVICE_STRUCT.unpack_from(data, pos)
+                pos += DEVICE_STRUCT.size
+                name = data[pos:pos + name_length].decode()
+                pos += name_length
+                joysticks[instance_id] = ReplayJoystick(instance_id, name)
+                continue
+            if record_type not in [RECORD_AXIS, RECORD_BUTTON_DOWN, RECORD_BUTTON_UP]:
+                raise FrankenUsbReplayException(f"{path}: unknown record type {record_type}")
+            t_ns, instance_id, number, value = EVENT_STRUCT.unpack_from(data, pos)
+            pos += EVENT_STRUCT.size
+            if not batches or batches[-1][0] != t_ns:
+                batches.append((t_ns, []))
+            batches[-1][1].append((record_type, instance_id, number, value))
+    except struct.error as exc:
+        raise FrankenUsbReplayException(f"{path}: truncated recording") from exc
+    return joysticks, batches
+
+
+def make_event(joystick, record_type, number, value):
+    """Make a pygame event from a recorded event and update the fake joystick."""
+    if record_type == RECORD_AXIS:
+        joystick.axes[number] = value
+        return pygame.event.Event(pygame.JOYAXISMOTION,  # pylint: disable=no-member
+                                  instance_id=joystick.instance_id, axis=number, value=value)
+    if record_type == RECORD_BUTTON_DOWN:
+        joystick.buttons[number] = 1
+        return pygame.event.Event(pygame.JOYBUTTONDOWN,  # pylint: disable=no-member
+                                  instance_id=joystick.instance_id, button=number)
+    joystick.buttons[number] = 0
+    return pygame.event.Event(pygame.JOYBUTTONUP,  # pylint: disable=no-member
+                              instance_id=joystick.instance_id, button=number)
+
+
+class EventReplayer():  # pylint: disable=too-few-public-methods
+    """Feed a recording to FrankenUsb in place of pygame."""
+
+    def __init__(self, joysticks, batches, speed=1.0):
+        """Initialize with joysticks and batches as returned by read_recording().
+
+        speed is relative to real time, 0 means as fast as possible.
+        """
+        self.joysticks = joysticks
+        self.batches = batches
+        self.speed = speed
+
+    @classmethod
+    def from_file(cls, path, speed=1.0):
+        """Make a replayer for a recording."""
+        joysticks, batches = read_recording(path)
+        return cls(joysticks, batches, speed)
+
+    async def run(self, franken):
+        """Replay all events into franken.
+
+        In real time mode the events are handed over when they are
+        due. As fast as possible mode waits for the event queue to
+        be empty before handing over the next batch.
+        """
+        start = time.monotonic_ns()
+        first = self.batches[0][0] if self.batches else 0
+        for t_ns, records in self.batches:
+            if self.speed > 0:
+                delay = start + (t_ns - first) / self.speed - time.monotonic_ns()
+                if delay > 0:
+                    await asyncio.sleep(delay / 1e9)
+            else:
+                while franken.axis_event_queue.qsize() > 0:
+                    await asyncio.sleep(0)
+            events = [make_event(self.joysticks[instance_id], record_type, number, value)
+                      for record_type, instance_id, number, value in records]
+            franken.queue_pygame_events(*franken.coalesce_pygame_events(events))
+        while franken.axis_event_queue.qsize() > 0:
+            await asyncio.sleep(0)
+        return sum(len(records) for _, records in self.batches)
@@ -0,0 +1,324 @@
+"""Read joysticks in a separate process for frankenusb.
+
+With --input-backend process, an input process owns pygame and does
+nothing but read joystick events and write them to a ring buffer in
+shared memory. A slow PSX write or a garbage collection pause in the
+main process then no longer delays reading the hardware, and the
+time an event was read (t_read) is taken in the input process.
+
+The ring buffer has a single writer and a single reader:
+
+  the number of records published so far (uint64)
+  then RING_CAPACITY slots of SLOT_SIZE bytes, each:
+      sequence number of the record (uint64)
+      time read (int64, time.monotonic_ns()), record type (uint8),
+      instance id (int32), axis/button number (uint16), value (float32)
+      for DEVICE ADDED: name length (uint8), name (utf-8)
+
+Record types AXIS, BUTTON DOWN and BUTTON UP are as in a recording
+(frankenusb_replay). AXIS STATE and BUTTON STATE give the position
+of every axis and button when a device is added, they update the
+stand-in joystick in the main process without causing an event.
+
+The writer marks a slot as being written before it changes it and
+publishes the records of a batch of pygame events together. If the
+reader falls so far behind that the writer laps it, the records that
+were overwritten are counted as overruns and skipped. If that loses
+the DEVICE ADDED of a device, the reader asks the input process to
+write DEVICE ADDED and the state of all its devices again. This relies on
+writes to shared memory becoming visible in the order they are made,
+as they do on x86.
+"""
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+import pygame  # pylint: disable=import-error
+from frankenusb_replay import (ReplayJoystick, make_event, RECORD_AXIS,
+                               RECORD_BUTTON_DOWN, RECORD_BUTTON_UP)
+
+RECORD_DEVICE_ADDED = 4
+RECORD_DEVICE_REMOVED = 5
+RECORD_AXIS_STATE = 6
+RECORD_BUTTON_STATE = 7
+
+SEQ_STRUCT = struct.Struct('<Q')
+RECORD_STRUCT = struct.Struct('<qBiHf')
+SLOT_SIZE = 128
+NAME_OFFSET = SEQ_STRUCT.size + RECORD_STRUCT.size
+MAX_NAME_LENGTH = SLOT_SIZE - NAME_OFFSET - 1
+RING_CAPACITY = 4096
+# Sequence number of a slot that is being written
+WRITING = 2 ** 64 - 1
+
+# How long the input process waits for an event before checking if it should stop (ms)
+INPUT_WAIT = 200
+# How long we wait for the input process to open the joysticks (s)
+START_TIMEOUT = 30.0
+
+
+class FrankenUsbShmException(Exception):
+    """FrankenUSB shared memory exception.
+
+    Raised when the input process cannot be started.
+    """
+
+
+class ShmRing():
+    """A ring buffer of input records in shared memory."""
+
+    def __init__(self, name=None, capacity=RING_CAPACITY):
+        """Create a new ring buffer, or attach to an existing one by name."""
+        self.capacity = capacity
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=SEQ_STRUCT.size + capacity * SLOT_SIZE)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.buf = self.shm.buf
+        # The next record we write or read
+        self.seq = 0
+        # Records the writer overwrote before we read them
+        self.overruns = 0
+
+    def slot_offset(self, seq):
+        """Get the offset of the slot for record seq."""
+        return SEQ_STRUCT.size + (seq % self.capacity) * SLOT_SIZE
+
+    def write(self, t_read, record_type, instance_id, number, value, name=None):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """Write a record, it is not seen by the reader until publish()."""
+        buf = self.buf
+        offset = self.slot_offset(self.seq)
+        SEQ_STRUCT.pack_into(buf, offset, WRITING)
+        RECORD_STRUCT.pack_into(buf, offset + SEQ_STRUCT.size,
+                                t_read, record_type, instance_id, number, value)
+        if name is not None:
+            data = name.encode()[:MAX_NAME_LENGTH]
+            buf[offset + NAME_OFFSET] = len(data)
+            buf[offset + NAME_OFFSET + 1:offset + NAME_OFFSET + 1 + len(data)] = data
+        SEQ_STRUCT.pack_into(buf, offset, self.seq)
+        self.seq += 1
+
+    def publish(self):
+        """Make all records written so far visible to the reader."""
+        SEQ_STRUCT.pack_into(self.buf, 0, self.seq)
+
+    def read(self):
+        """Read the records published since the last read.
+
+        Returns a list of (t_read, record type, instance id, number,
+        value, name), name is None except for DEVICE ADDED.
+        """
+        buf = self.buf
+        published = SEQ_STRUCT.unpack_from(buf, 0)[0]
+        if published - self.seq > self.capacity:
+            self.overruns += published - self.seq - self.capacity
+            self.seq = published - self.capacity
+        records = []
+        while self.seq < published:
+            offset = self.slot_offset(self.seq)
+            record = RECORD_STRUCT.unpack_from(buf, offset + SEQ_STRUCT.size)
+            name = None
+            if record[1] == RECORD_DEVICE_ADDED:
+                length = buf[offset + NAME_OFFSET]
+                name = bytes(buf[offset + NAME_OFFSET + 1:offset + NAME_OFFSET + 1 + length])
+                name = name.decode(errors='replace')
+            # Checked after reading, the writer may have lapped us meanwhile
+            if SEQ_STRUCT.unpack_from(buf, offset)[0] != self.seq:
+                self.overruns += 1
+            else:
+                records.append(record + (name,))
+            self.seq += 1
+        return records
+
+    def close(self, unlink=False):
+        """Detach from the shared memory, unlink it when we created it."""
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def open_device(ring, joysticks, device_index, t_read):
+    """Open a joystick in the input process and write its current state."""
+    joy = pygame.joystick.Joystick(device_index)
+    instance_id = joy.get_instance_id()
+    if instance_id in joysticks:
+        # Already open, e.g the JOYDEVICEADDED event SDL sends at startup
+        return
+    joy.init()
+    joysticks[instance_id] = joy
+    write_device(ring, joy, t_read)
+
+
+def write_device(ring, joy, t_read):
+    """Write DEVICE ADDED and the current state of an open joystick."""
+    instance_id = joy.get_instance_id()
+    ring.write(t_read, RECORD_DEVICE_ADDED, instance_id, 0, 0.0, joy.get_name())
+    for axis in range(joy.get_numaxes()):
+        ring.write(t_read, RECORD_AXIS_STATE, instance_id, axis, joy.get_axis(axis))
+    for button in range(joy.get_numbuttons()):
+        ring.write(t_read, RECORD_BUTTON_STATE, instance_id, button, joy.get_button(button))
+
+
+def write_event(ring, joysticks, event, t_read):
+    """Write a pygame event to the ring buffer."""
+    if event.type == pygame.JOYAXISMOTION:  # pylint: disable=no-member
+        ring.write(t_read, RECORD_AXIS, event.instance_id, event.axis, event.value)
+    elif event.type == pygame.JOYBUTTONDOWN:  # pylint: disable=no-member
+        ring.write(t_read, RECORD_BUTTON_DOWN, event.instance_id, event.button, 0.0)
+    elif event.type == pygame.JOYBUTTONUP:  # pylint: disable=no-member
+        ring.write(t_read, RECORD_BUTTON_UP, event.instance_id, event.button, 0.0)
+    elif event.type == pygame.JOYDEVICEADDED:  # pylint: disable=no-member
+        open_device(ring, joysticks, event.device_index, t_read)
+    elif event.type == pygame.JOYDEVICEREMOVED:  # pylint: disable=no-member
+        joy = joysticks.pop(event.instance_id, None)
+        if joy is not None:
+            joy.quit()
+            ring.write(t_read, RECORD_DEVICE_REMOVED, event.instance_id, 0, 0.0)
+
+
+def input_process_main(shm_name, capacity, data_ready, ready, stop, resync):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """Read joystick events with pygame and write them to the ring buffer.
+
+    Runs in the input process until stop is set or the main process
+    is gone. Sets ready when the joysticks we have at startup are in
+    the ring buffer, and data_ready whenever something is published.
+    When resync is set, all open joysticks are written again.
+    """
+    ring = ShmRing(shm_name, capacity)
+    pygame.init()  # pylint: disable=no-member
+    pygame.joystick.init()
+    pygame.event.set_blocked(None)
+    pygame.event.set_allowed([pygame.JOYAXISMOTION,  # pylint: disable=no-member
+                              pygame.JOYBUTTONUP,  # pylint: disable=no-member
+                              pygame.JOYBUTTONDOWN,  # pylint: disable=no-member
+                              pygame.JOYDEVICEADDED,  # pylint: disable=no-member
+                              pygame.JOYDEVICEREMOVED])  # pylint: disable=no-member
+    joysticks = {}
+    t_read = time.monotonic_ns()
+    for device_index in range(pygame.joystick.get_count()):
+        open_device(ring, joysticks, device_index, t_read)
+    ring.publish()
+    ready.set()
+    parent = multiprocessing.parent_process()
+    try:
+        while not stop.is_set():
+            if resync.is_set():
+                resync.clear()
+                t_read = time.monotonic_ns()
+                for joy in joysticks.values():
+                    write_device(ring, joy, t_read)
+                ring.publish()
+                data_ready.set()
+            event = pygame.event.wait(INPUT_WAIT)
+            if event.type == pygame.NOEVENT:  # pylint: disable=no-member
+                if parent is not None and not parent.is_alive():
+                    break
+                continue
+            t_read = time.monotonic_ns()
+            for event in [event] + pygame.event.get():
+                write_event(ring, joysticks, event, t_read)
+            ring.publish()
+            data_ready.set()
+    finally:
+        ring.close()
+        pygame.quit()  # pylint: disable=no-member
+
+
+class InputProcess():  # pylint: disable=too-many-instance-attributes
+    """Run the input process and turn its records into pygame events."""
+
+    def __init__(self, capacity=RING_CAPACITY):
+        """Create the ring buffer, start() starts the process."""
+        self.ring = ShmRing(capacity=capacity)
+        # spawn, so the input process does not inherit the SDL state of the main process
+        context = multiprocessing.get_context('spawn')
+        self.data_ready = context.Event()
+        self.ready = context.Event()
+        self.stop_event = context.Event()
+        self.resync = context.Event()
+        self.process = context.Process(
+            target=input_process_main, name="frankenusb input", daemon=True,
+            args=(self.ring.shm.name, capacity, self.data_ready, self.ready, self.stop_event,
+                  self.resync))
+        # instance id -> ReplayJoystick with the latest axis and button state
+        self.joysticks = {}
+        # Records for devices we had no DEVICE ADDED for
+        self.unknown = 0
+
+    def start(self):
+        """Start the input process and wait for it to open the joysticks."""
+        self.process.start()
+        deadline = time.monotonic() + START_TIMEOUT
+        while not self.ready.wait(0.1):
+            if not self.process.is_alive() or time.monotonic() > deadline:
+                self.stop()
+                raise FrankenUsbShmException("input process did not start")
+
+    def stop(self):
+        """Stop the input process and free the ring buffer."""
+        self.stop_event.set()
+        if self.process.is_alive():
+            self.process.join(INPUT_WAIT / 1000 * 5)
+            if self.process.is_alive():
+                self.process.terminate()
+        if self.ring.buf is not None:
+            self.ring.close(unlink=True)
+
+    def is_alive(self):
+        """Check if the input process is running."""
+        return self.process.is_alive()
+
+    def wait(self, timeout):
+        """Wait for the input process to publish, True if it did."""
+        if not self.data_ready.wait(timeout):
+            return False
+        # Cleared before reading, so anything published from now on sets it again
+        self.data_ready.clear()
+        return True
+
+    @property
+    def overruns(self):
+        """Get the number of records lost because we read too slowly."""
+        return self.ring.overruns
+
+    def read(self):
+        """Read the events published since the last read.
+
+        Returns a list of (t_read, [pygame event, ...]) with the
+        events that were read together. JOYDEVICEADDED events have
+        the instance id of the device, its stand-in joystick is in
+        self.joysticks.
+
+        Records for a device we have no DEVICE ADDED for (lost in an
+        overrun) are counted in self.unknown and skipped, and the
+        input process is asked to write all its devices again.
+        """
+        batches = []
+        for t_read, record_type, instance_id, number, value, name in self.ring.read():
+            if not batches or batches[-1][0] != t_read:
+                batches.append((t_read, []))
+            joystick = self.joysticks.get(instance_id)
+            if record_type == RECORD_DEVICE_ADDED:
+                # Keep the stand-in when a device is written again after a resync
+                if joystick is None or joystick.name != name:
+                    self.joysticks[instance_id] = ReplayJoystick(instance_id, name)
+                batches[-1][1].append(pygame.event.Event(
+                    pygame.JOYDEVICEADDED, instance_id=instance_id))  # pylint: disable=no-member
+                continue
+            if joystick is None:
+                self.unknown += 1
+                self.resync.set()
+                continue
+            if record_type == RECORD_DEVICE_REMOVED:
+                del self.joysticks[instance_id]
+                batches[-1][1].append(pygame.event.Event(
+                    pygame.JOYDEVICEREMOVED, instance_id=instance_id))  # pylint: disable=no-member
+            elif record_type == RECORD_AXIS_STATE:
+                joystick.axes[number] = value
+            elif record_type == RECORD_BUTTON_STATE:
+                joystick.buttons[number] = int(value)
+            else:
+                batches[-1][1].append(make_event(joystick, record_type, number, value))
+        return [batch for batch in batches if batch[1]]
@@ -0,0 +1,81 @@
+"""Sound cues for frankenusb.
+
+Every sound in CONFIG_MISC (keys ending in _SOUND) is decoded once at
+startup. Playing a cue only queues a request, the actual playing is
+done by a separate coroutine on a mixer channel reserved for cues.
+A cue is not played again until its cooldown has passed, and never
+while the previous cue is still playing, so moving a lever back and
+forth does not stack up sounds.
+"""
+import asyncio
+import time
+import pygame  # pylint: disable=import-error
+
+# Seconds before the same cue can be played again, unless set in
+# CONFIG_MISC['SOUND_COOLDOWNS']
+DEFAULT_COOLDOWN = 1.0
+
+
+class SoundCues():
+    """Preloaded, rate-limited sound cues."""
+
+    def __init__(self, logger):
+        """Initialize the class."""
+        self.logger = logger
+        # cue name (config key without _SOUND) -> pygame.mixer.Sound
+        self.sounds = {}
+        # cue name -> cooldown (s)
+        self.cooldowns = {}
+        # cue name -> time.monotonic() when last played
+        self.last_played = {}
+        self.channel = None
+        self.queue = asyncio.Queue(maxsize=0)
+        # Cues in the queue, so we never queue the same cue twice
+        self.pending = set()
+
+    def load(self, config_misc):
+        """Decode all configured sounds and reserve a mixer channel."""
+        if not pygame.mixer.get_init():
+            try:
+                pygame.mixer.init()
+            except pygame.error as exc:  # pylint: disable=no-member
+                self.logger.warning("No sound available, disabling sound cues: %s", exc)
+                return
+        pygame.mixer.set_reserved(1)
+        self.channel = pygame.mixer.Channel(0)
+        cooldowns = config_misc.get('SOUND_COOLDOWNS', {})
+        for key, filename in config_misc.items():
+            if not key.endswith('_SOUND'):
+                continue
+            name = key[:-len('_SOUND')]
+            try:
+                self.sounds[name] = pygame.mixer.Sound(filename)
+            except (pygame.error, FileNotFoundError) as exc:  # pylint: disable=no-member
+                self.logger.warning("Failed to load sound %s from %s: %s", key, filename, exc)
+                continue
+            self.cooldowns[name] = cooldowns.get(key, DEFAULT_COOLDOWN)
+            self.logger.info("Loaded sound %s from %s", key, filename)
+
+    def play(self, name):
+        """Ask for a cue to be played.
+
+        Never blocks, and does nothing if the cue is unknown, already
+        queued or was played less than its cooldown ago.
+        """
+        if name not in self.sounds or name in self.pending:
+            return
+        if time.monotonic() - self.last_played.get(name, 0.0) < self.cooldowns[name]:
+            return
+        self.pending.add(name)
+        self.queue.put_nowait(name)
+
+    async def player(self):
+        """Play queued cues."""
+        while True:
+            name = await self.queue.get()
+            self.pending.discard(name)
+            if self.channel.get_busy():
+                self.logger.debug("Sound channel busy, skipping cue %s", name)
+                continue
+            self.channel.play(self.sounds[name])
+            self.last_played[name] = time.monotonic()
@@ -0,0 +1,137 @@
+"""Latency histograms and event counters for frankenusb.
+
+The histograms are HDR-style: values (nanoseconds) are grouped by
+power of two, and each power of two is split into SUB_BUCKETS linear
+buckets. That gives a fixed relative error (about 3% with 32 buckets)
+over the whole range from nanoseconds to minutes, in a small
+preallocated array, with recording a value being a few integer
+operations.
+"""
+from array import array
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# Values above 2**(MAX_SHIFT + SUB_BUCKET_BITS + 1) ns (about 10 minutes)
+# all end up in the last bucket
+MAX_SHIFT = 34
+NUM_BUCKETS = (MAX_SHIFT + 2) * SUB_BUCKETS
+
+
+def bucket_index(value):
+    """Get the bucket index for a value."""
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    if shift <= 0:
+        return value
+    if shift > MAX_SHIFT:
+        return NUM_BUCKETS - 1
+    return shift * SUB_BUCKETS + (value >> shift)
+
+
+def bucket_value(index):
+    """Get the value in the middle of a bucket."""
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    sub = index - shift * SUB_BUCKETS
+    return (sub << shift) + (1 << (shift - 1))
+
+
+class LatencyHistogram():
+    """Histogram of latencies in nanoseconds."""
+
+    __slots__ = ('counts', 'count', 'max')
+
+    def __init__(self):
+        """Initialize an empty histogram."""
+        self.counts = array('Q', bytes(8 * NUM_BUCKETS))
+        self.count = 0
+        self.max = 0
+
+    def record(self, value):
+        """Record one latency (ns)."""
+        value = max(value, 0)
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """Add all values recorded in another histogram to this one."""
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Get the latency (ns) that percent of the recorded values are below."""
+        if self.count == 0:
+            return 0
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return min(bucket_value(index), self.max)
+        return self.max
+
+
+def display_name(name):
+    """Get a printable name for a histogram or counter.
+
+    Names are strings or tuples, e.g ('read to wire', 'FltControls').
+    Tuples avoid formatting a string on every recorded value.
+    """
+    if isinstance(name, tuple):
+        return ' '.join(str(elem) for elem in name)
+    return name
+
+
+class LatencyStats():
+    """Named latency histograms and event counters."""
+
+    def __init__(self):
+        """Initialize with no histograms or counters."""
+        # name -> LatencyHistogram
+        self.histograms = {}
+        # name -> count
+        self.counters = {}
+
+    def record(self, name, value):
+        """Record a latency (ns) in the histogram called name."""
+        try:
+            self.histograms[name].record(value)
+        except KeyError:
+            self.histograms[name] = LatencyHistogram()
+            self.histograms[name].record(value)
+
+    def count(self, name, increment=1):
+        """Increment the counter called name."""
+        self.counters[name] = self.counters.get(name, 0) + increment
+
+    def summary(self):
+        """Get a dict with percentiles (ms) per histogram and all counters."""
+        return {
+            'latency': {
+                display_name(name): {
+                    'count': histogram.count,
+                    'p50': histogram.percentile(50) / 1e6,
+                    'p95': histogram.percentile(95) / 1e6,
+                    'p99': histogram.percentile(99) / 1e6,
+                    'max': histogram.max / 1e6,
+                }
+                for name, histogram in self.histograms.items()
+            },
+            'counters': {display_name(name): count for name, count in self.counters.items()},
+        }
+
+    def report_lines(self):
+        """Get the summary as human readable lines."""
+        summary = self.summary()
+        lines = []
+        for name, data in sorted(summary['latency'].items()):
+            lines.append(
+                f"{name}: n={data['count']} p50={data['p50']:.2f}ms p95={data['p95']:.2f}ms "
+                f"p99={data['p99']:.2f}ms max={data['max']:.2f}ms")
+        for name, count in sorted(summary['counters'].items()):
+            lines.append(f"{name}: {count}")
+        return lines
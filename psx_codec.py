@@ -0,0 +1,277 @@
+"""Field layouts of PSX variables, and records that parse them lazily.
+
+Most PSX variables the scripts in this repo use are a list of fields
+separated by ";" (e.g FltControls "elevator;aileron;rudder"), some
+with a leading "d" (FuelQty), and a few are fixed width digit strings
+(Towing). Instead of every script splitting and joining these by
+hand, the layout of each variable is declared once in LAYOUTS:
+
+  field name (or None if we don't use it), field type (int, float or str)
+
+and a PsxRecord holds the raw string of one variable. It only splits
+and converts the string when a field is read, and only again when
+the raw string has changed, so a variable that changes much more
+often than we look at it (e.g Tla while the autothrottle moves the
+levers) costs next to nothing. Setting a field changes just that
+field, and the new string is put together when encode() is called.
+
+record = PsxRecord('Towing', psx.get('Towing'))
+record['heading'] = 90
+psx.send('Towing', record.encode())
+
+Fields can be read and set by name or by index. Variables without a
+declared layout get a layout of str fields separated by ";".
+
+A PsxVector is for variables we send often and change field by
+field from several places, e.g FltControls from the aileron, elevator
+and rudder axes. It keeps the fields split between sends.
+
+See https://aerowinx.com/assets/networkers/Network%20Documentation.txt
+for the PSX variables.
+"""
+# pylint: disable=too-few-public-methods
+
+
+class PsxCodecException(Exception):
+    """PSX codec exception.
+
+    Raised when a field does not exist or does not have the type of
+    the layout, or a value does not fit a fixed width field.
+    """
+
+
+class PsxLayout():
+    """The field layout of a PSX variable."""
+
+    __slots__ = ('variable', 'prefix', 'separator', 'widths', 'types', 'names')
+
+    def __init__(self, variable, fields, prefix='', widths=None):
+        """Initialize from a list of (field name, field type).
+
+        With widths, the fields are fixed width digits without
+        separator, else they are separated by ";".
+        """
+        self.variable = variable
+        self.prefix = prefix
+        self.separator = None if widths else ';'
+        self.widths = tuple(widths) if widths else None
+        self.types = tuple(field_type for _, field_type in fields)
+        self.names = {name: index for index, (name, _) in enumerate(fields) if name is not None}
+
+    def index(self, key):
+        """Get the index of a field from its name or index."""
+        if isinstance(key, int):
+            return key
+        try:
+            return self.names[key]
+        except KeyError as exc:
+            raise PsxCodecException(f"{self.variable} has no field {key}") from exc
+
+    def split(self, raw):
+        """Split a raw PSX string into a list of field strings."""
+        if self.prefix and raw.startswith(self.prefix):
+            raw = raw[len(self.prefix):]
+        if self.separator is not None:
+            return raw.split(self.separator)
+        fields = []
+        pos = 0
+        for width in self.widths:
+            fields.append(raw[pos:pos + width])
+            pos += width
+        return fields
+
+    def join(self, fields):
+        """Put a raw PSX string together from a list of field strings."""
+        if self.separator is not None:
+            return self.prefix + self.separator.join(fields)
+        return self.prefix + ''.join(fields)
+
+    def convert(self, index, field):
+        """Convert a field string to the type of the field."""
+        if index >= len(self.types) or self.types[index] is str:
+            return field
+        try:
+            return self.types[index](field)
+        except ValueError as exc:
+            raise PsxCodecException(
+                f"field {index} of {self.variable} is not a {self.types[index].__name__}: "
+                f"{field!r}") from exc
+
+    def format(self, index, value):
+        """Format a field value as a field string."""
+        field = str(value)
+        if self.widths is not None:
+            if index >= len(self.widths):
+                raise PsxCodecException(f"{self.variable} has no field {index}")
+            field = field.zfill(self.widths[index])
+            if len(field) != self.widths[index]:
+                raise PsxCodecException(
+                    f"{value} does not fit field {index} of {self.variable}")
+        return field
+
+
+def int_fields(*names):
+    """Make a list of int fields."""
+    return [(name, int) for name in names]
+
+
+LAYOUTS = {layout.variable: layout for layout in [
+    PsxLayout('FltControls', int_fields('elevator', 'aileron', 'rudder')),
+    PsxLayout('Brakes', int_fields('left', 'right')),
+    PsxLayout('Tiller', int_fields('tiller')),
+    PsxLayout('SpdBrkLever', int_fields('speedbrake')),
+    PsxLayout('Tla', int_fields('engine 1', 'engine 2', 'engine 3', 'engine 4')),
+    # Only the autothrottle mode is used, 0 = blank, 21 = HOLD
+    PsxLayout('Afds', int_fields('at mode')),
+    PsxLayout('PiBaHeAlTas', [('pitch', float), ('bank', float), ('heading', float),
+                              ('altitude', float), ('tas', float),
+                              ('latitude', float), ('longitude', float)]),
+    # Tank quantities in 0.1 lb, the first nine fields are tanks
+    PsxLayout('FuelQty', int_fields('main 1', 'main 2', 'main 3', 'main 4',
+                                    'reserve 2', 'reserve 3', 'center', None, None),
+              prefix='d'),
+    # Frequencies as e.g "121500"
+    PsxLayout('MemRcpL', [('vhf l active', str), (None, str), (None, str), (None, str),
+                          ('vhf r active', str)]),
+    # Direction (1 = pushback, 2 = push forward), mode, heading (degrees)
+    PsxLayout('Towing', [('direction', str), ('mode', str), ('heading', int)],
+              widths=(1, 2, 3)),
+]}
+
+
+def get_layout(variable):
+    """Get the layout of a variable, a generic one if it is not in LAYOUTS."""
+    layout = LAYOUTS.get(variable)
+    if layout is None:
+        layout = LAYOUTS[variable] = PsxLayout(variable, [])
+    return layout
+
+
+class PsxRecord():
+    """The value of one PSX variable, parsed when a field is first read."""
+
+    __slots__ = ('layout', 'raw', 'fields', 'values')
+
+    def __init__(self, variable, raw=''):
+        """Initialize with the raw PSX string of variable."""
+        self.layout = get_layout(variable)
+        self.raw = raw
+        # The field strings and values, None until we need them
+        self.fields = None
+        self.values = None
+
+    def update(self, raw):
+        """Set a new raw PSX string, returns True if it changed."""
+        if raw == self.raw:
+            return False
+        self.raw = raw
+        self.fields = None
+        self.values = None
+        return True
+
+    def parse(self):
+        """Split and convert the raw string if we haven't already."""
+        if self.values is None:
+            if self.fields is None:
+                self.fields = self.layout.split(self.raw)
+            self.values = [self.layout.convert(index, field)
+                           for index, field in enumerate(self.fields)]
+        return self.values
+
+    def __getitem__(self, key):
+        """Get a field value by name or index."""
+        try:
+            return self.parse()[self.layout.index(key)]
+        except IndexError as exc:
+            raise PsxCodecException(
+                f"{self.layout.variable}={self.raw} has no field {key}") from exc
+
+    def __setitem__(self, key, value):
+        """Set a field value by name or index."""
+        values = self.parse()
+        index = self.layout.index(key)
+        if index >= len(values):
+            raise PsxCodecException(f"{self.layout.variable}={self.raw} has no field {key}")
+        self.fields[index] = self.layout.format(index, value)
+        values[index] = self.layout.convert(index, self.fields[index])
+        self.raw = None
+
+    def __len__(self):
+        """Get the number of fields."""
+        return len(self.parse())
+
+    def encode(self):
+        """Get the raw PSX string, with any fields we have set."""
+        if self.raw is None:
+            self.raw = self.layout.join(self.fields)
+        return self.raw
+
+
+class PsxVector():
+    """A PSX variable that we change field by field, e.g FltControls.
+
+    Several axes can write to different fields of the same variable.
+    The fields are kept split and updated in place, from PSX with
+    received() and by us with set(), which only marks a field dirty
+    if it changes it. emit() puts in the dirty fields and joins, so a
+    send costs the changed fields and one join, and nothing at all if
+    no field has changed.
+    """
+
+    __slots__ = ('layout', 'raw', 'fields', 'dirty')
+
+    def __init__(self, variable, raw=''):
+        """Initialize with the raw PSX string of variable."""
+        self.layout = get_layout(variable)
+        self.raw = raw
+        # The field strings of raw, None until we need them
+        self.fields = None
+        # index -> field string, waiting for emit()
+        self.dirty = {}
+
+    def received(self, raw):
+        """Take a new raw PSX string from PSX, dirty fields stay dirty."""
+        if raw != self.raw:
+            self.raw = raw
+            self.fields = None
+
+    def split(self):
+        """Get the field strings, splitting raw if we haven't already."""
+        if self.fields is None:
+            self.fields = self.layout.split(self.raw)
+        return self.fields
+
+    def set(self, index, value):
+        """Set a field by index, it is sent with the next emit()."""
+        fields = self.fields
+        if fields is None:
+            fields = self.split()
+        if index >= len(fields):
+            raise PsxCodecException(f"{self.layout.variable}={self.raw} has no field {index}")
+        if self.layout.widths is None:
+            field = str(value)
+        else:
+            field = self.layout.format(index, value)
+        if fields[index] != field:
+            self.dirty[index] = field
+        elif self.dirty:
+            self.dirty.pop(index, None)
+
+    def emit(self):
+        """Get the raw PSX string with the dirty fields, None if nothing changed."""
+        dirty = self.dirty
+        if not dirty:
+            return None
+        fields = self.fields
+        if fields is None:
+            fields = self.split()
+        changed = False
+        for index, field in dirty.items():
+            if fields[index] != field:
+                fields[index] = field
+                changed = True
+        dirty.clear()
+        if not changed:
+            return None
+        self.raw = self.layout.join(fields)
+        return self.raw
@@ -5,6 +5,7 @@ import sys
 import threading
 import time
 from psx import Client
+from psx_codec import PsxRecord
 # pylint: disable=missing-function-docstring,global-statement,invalid-name
 
 PSX = None
@@ -98,13 +99,10 @@ This script simulates additional tanks in the hold. Usage:
             print()
             print(f"Status at {datetime.datetime.now()}")
             zfw_kg = lb2kg(PSX.get("TrueZfw"))
-            fuelqty = PSX.get("FuelQty")
-            # Remove intial "d"
-            fuelqty = fuelqty[1:]
-            fuelqty_split = fuelqty.split(';')
+            fuelqty = PsxRecord("FuelQty", PSX.get("FuelQty"))
             fuelqty_total = 0.0
             for elem in range(0, 9):
-                fuelqty_total += int(fuelqty_split[elem]) / 10
+                fuelqty_total += fuelqty[elem] / 10
             fuelqty_total_kg = lb2kg(fuelqty_total)
             fuelqty_total_real = (zfw_kg - zfw_target) + fuelqty_total_kg
             print(f"Sum of fuel in PSX tanks: {fuelqty_total_kg:.0f}")
@@ -114,7 +112,7 @@ This script simulates additional tanks in the hold. Usage:
             # d300292;830812;830790;300292;88295;88295;1142282;221102;214951;404491;587;
             #  main1   main2  main3  main4
 
-            fuelqty_center_kg = lb2kg(float(fuelqty_split[6]) / 10)
+            fuelqty_center_kg = lb2kg(fuelqty['center'] / 10)
             print(
                 f"Current ZFW={zfw_kg:.0f} (target={zfw_target:.0f}), " +
                 f"CENTER={fuelqty_center_kg:.0f} kg (max={CENTER_MAX}), " +
@@ -133,11 +131,10 @@ This script simulates additional tanks in the hold. Usage:
                 zfw_kg_new = zfw_kg - proposed_transfer
                 fuelqty_center_kg_new = fuelqty_center_kg + proposed_transfer
 
-                fuelqty_split[6] = str(int(10 * kg2lb(fuelqty_center_kg_new)))
-                fuelqty_new = "d" + ";".join(fuelqty_split)
+                fuelqty['center'] = int(10 * kg2lb(fuelqty_center_kg_new))
 
                 psx_send_and_set("TrueZfw", str(int(kg2lb(zfw_kg_new))))
-                psx_send_and_set("FuelQty", fuelqty_new)
+                psx_send_and_set("FuelQty", fuelqty.encode())
             print(f"Sleeping {INTERVAL} s")
             time.sleep(INTERVAL)
 
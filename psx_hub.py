@@ -0,0 +1,224 @@
+"""Share one PSX connection between all the local PSX scripts.
+
+Every PSX client connection makes the PSX main server send every
+variable update one more time. With several scripts running on the
+same PC (frankenusb, comparator, show_psx, psx_fuel_transfer...),
+run this hub there instead. It holds the only connection to the PSX
+main server and speaks enough of the PSX network protocol for the
+scripts (and Hoppie's psx.py) to connect to it as if it were PSX:
+
+- greets each local client with the PSX version, a lexicon, and the
+  current value of all variables
+- sends every update from PSX on to all local clients
+- sends writes from local clients on to PSX, in the order they
+  arrive, and to the other local clients
+- asks PSX for demand variables once, when the first local client
+  demands them
+- drops all local clients while PSX is not connected, and reconnects
+
+Local clients connect to --host/--port, by default the standard PSX
+port on this PC, so run PSX itself on another PC or move the hub to
+another port (frankenusb has --psx-port).
+
+The local side is loopback TCP rather than a Unix socket or shared
+memory, as Unix sockets are not available with asyncio on Windows
+and psx.py only speaks TCP anyway.
+"""
+# pylint: disable=invalid-name
+import argparse
+import asyncio
+import logging
+from psx_standin import PsxStandIn, PSX_PORT
+
+# Wait this long before reconnecting to PSX (s)
+RECONNECT_INTERVAL = 5.0
+
+
+class PsxHubException(Exception):
+    """PSX hub exception.
+
+    For now, no special handling, this class just exists to make
+    pylint happy. :)
+    """
+
+
+class PsxHub(PsxStandIn):  # pylint: disable=too-many-instance-attributes
+    """A PSX stand-in that mirrors a real PSX main server."""
+
+    def __init__(self, lexicon=True, logger=None):
+        """Initialize the hub, all variables come from PSX."""
+        super().__init__(lexicon=lexicon,
+                         logger=logger if logger is not None else logging.getLogger("psx_hub"))
+        self.variables = {}
+        self.codes = {}
+        self.names = {}
+        self.keep_writes = False
+        self.version = None
+        # The connection to PSX, None while not connected
+        self.upstream_writer = None
+        # variable name -> PSX Q code and back
+        self.upstream_codes = {}
+        self.upstream_names = {}
+        # Set when PSX has sent us all variables
+        self.ready = asyncio.Event()
+        self.upstream_lines = 0
+        self.forwarded_lines = 0
+
+    def send_upstream(self, line):
+        """Send a line to PSX."""
+        if self.upstream_writer is None:
+            self.logger.warning("PSX not connected, dropping %s", line)
+            return
+        self.upstream_writer.write(f"{line}\n".encode())
+        self.forwarded_lines += 1
+
+    def handle_line(self, session, line):
+        """Handle one line from a local client, sending writes on to PSX."""
+        key, sep, value = line.partition('=')
+        if not sep:
+            if key == "pleaseBeSoKindAndQuit":
+                self.logger.info("Client %d asked PSX to quit", session.client_id)
+                self.send_upstream(key)
+                return True
+        elif key == "demand":
+            name = self.names.get(value, value)
+            if name not in self.demand:
+                self.demand.add(name)
+                self.send_upstream(f"demand={name}")
+        else:
+            name = self.names.get(key, key)
+            self.send_upstream(f"{self.upstream_codes.get(name, name)}={value}")
+        return super().handle_line(session, line)
+
+    async def handle_client(self, reader, writer):
+        """Talk to one local client, if we have all variables from PSX."""
+        if not self.ready.is_set():
+            self.logger.info("Refusing client from %s, PSX not connected",
+                             writer.get_extra_info('peername'))
+            writer.close()
+            return
+        await super().handle_client(reader, writer)
+
+    async def start_server(self, host="127.0.0.1", port=PSX_PORT):
+        """Start listening for local clients."""
+        self.server = await asyncio.start_server(self.handle_client, host, port)
+        self.logger.info("PSX hub listening on %s:%d", host, port)
+        return self.server
+
+    def send_all(self, line):
+        """Send a line to all local clients."""
+        for session in self.sessions.values():
+            session.send_lines([line])
+
+    def handle_upstream_line(self, line):
+        """Handle one line from PSX."""
+        self.upstream_lines += 1
+        key, sep, value = line.partition('=')
+        if not sep:
+            # load1, load2, load3 around a situation load, and so on
+            if key == "load3":
+                self.ready.set()
+            if key:
+                self.send_all(key)
+        elif key.startswith('L') and '(' in key:
+            # Lexicon, e.g Ls123(E)=FltControls, local clients get our own
+            code = 'Q' + key[1:key.index('(')]
+            self.upstream_codes[value] = code
+            self.upstream_names[code] = value
+        elif key == "id":
+            self.logger.info("Connected to PSX as client #%s", value)
+        elif key == "version":
+            self.logger.info("PSX version %s", value)
+            self.version = value
+        else:
+            self.set_variable(self.upstream_names.get(key, key), value)
+
+    def drop_clients(self):
+        """Disconnect all local clients."""
+        for session in list(self.sessions.values()):
+            session.writer.close()
+
+    async def run_upstream(self, host, port):
+        """Stay connected to PSX and handle everything it sends."""
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError as exc:
+                self.logger.warning("Failed to connect to PSX at %s:%d: %s", host, port, exc)
+                await asyncio.sleep(RECONNECT_INTERVAL)
+                continue
+            self.logger.info("Connected to PSX at %s:%d", host, port)
+            self.upstream_writer = writer
+            for name in self.demand:
+                self.send_upstream(f"demand={name}")
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    self.handle_upstream_line(line.decode().strip())
+            except ConnectionError as exc:
+                self.logger.warning("PSX connection error: %s", exc)
+            finally:
+                self.upstream_writer = None
+                self.ready.clear()
+                writer.close()
+                self.drop_clients()
+            self.logger.warning("PSX disconnected, reconnecting in %.0f s", RECONNECT_INTERVAL)
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    async def stats_logger(self, interval):
+        """Log how much we have sent and received now and then."""
+        while True:
+            await asyncio.sleep(interval)
+            self.logger.info("%d local clients, %d lines from PSX, %d lines to PSX",
+                             len(self.sessions), self.upstream_lines, self.forwarded_lines)
+
+
+def handle_args():
+    """Handle command line arguments."""
+    parser = argparse.ArgumentParser(
+        prog='psx_hub',
+        description='Share one PSX connection between local PSX clients')
+    parser.add_argument('--psx-host', action='store', required=True,
+                        help='the PSX main server')
+    parser.add_argument('--psx-port', action='store', default=PSX_PORT, type=int)
+    parser.add_argument('--host', action='store', default="127.0.0.1",
+                        help='where local clients connect')
+    parser.add_argument('--port', action='store', default=PSX_PORT, type=int,
+                        help='where local clients connect')
+    parser.add_argument('--stats-interval', action='store', default=0.0, type=float,
+                        help='log traffic counters every N seconds (0 = never)')
+    parser.add_argument('--no-lexicon', action='store_true',
+                        help='use variable names instead of Q codes towards local clients')
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--quiet', action='store_true')
+    return parser.parse_args()
+
+
+async def main():
+    """Start the hub."""
+    args = handle_args()
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO,
+                        datefmt="%H:%M:%S")
+    logger = logging.getLogger("psx_hub")
+    if args.quiet:
+        logger.setLevel(logging.CRITICAL)
+    elif args.debug:
+        logger.setLevel(logging.DEBUG)
+    hub = PsxHub(lexicon=not args.no_lexicon, logger=logger)
+    try:
+        server = await hub.start_server(args.host, args.port)
+    except OSError as inst:
+        raise PsxHubException(f"Failed to listen on {args.host}:{args.port}: {inst}") from inst
+    tasks = [server.serve_forever(), hub.run_upstream(args.psx_host, args.psx_port)]
+    if args.stats_interval > 0:
+        tasks.append(hub.stats_logger(args.stats_interval))
+    await asyncio.gather(*tasks)
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt as exc:
+        raise SystemExit("Stopped by keyboard interrupt (Ctrl-C)") from exc
@@ -0,0 +1,318 @@
+"""Local stand-in for a PSX main server.
+
+Speaks enough of the PSX network protocol to let the scripts in this
+repo (and Hoppie's psx.py) run without a real PSX, e.g for testing
+and benchmarking:
+
+- greets each client with id, version and the lexicon, followed by
+  load1, the current value of all variables, load2 and load3
+- handles demand=<variable> and bang (send everything again)
+- accepts key=value writes using either variable names or Q codes,
+  stores them and sends them on to all other clients
+- logs every write it receives with a timestamp
+- drops clients that stop reading, rather than buffering for them forever
+
+Variables can be changed over time by a scenario file, loaded the
+same way as the frankenusb config. It is a Python file that can
+contain:
+
+VARIABLES = {'Afds': '13;0;0', ...}  # added to/overriding the defaults
+DEMAND = {'GroundSpeed', ...}        # only sent to clients that demand them
+
+
+def evolve(t, variables):
+    # Called --tick-hz times per second with t = seconds since start,
+    # returns a dict of variables to change
+    return {'Tla': f"{int(t * 100) % 5000};0;0;0"}
+"""
+# pylint: disable=invalid-name
+import argparse
+import asyncio
+import importlib
+import logging
+import time
+
+PSX_PORT = 10747
+PSX_VERSION = "10.180 NG"
+# Drop a client when this much we sent it is still waiting to be written (bytes)
+MAX_CLIENT_BUFFER = 1024 * 1024
+
+# The variables used by the scripts in this repo, with sensible values
+DEFAULT_VARIABLES = {
+    'Afds': "0;0;0;0;0;0;0;0;0;0",
+    'Tla': "0;0;0;0",
+    'FltControls': "0;0;0",
+    'Brakes': "0;0",
+    'Tiller': "0",
+    'Towing': "120000",
+    'SpdBrkLever': "0",
+    'FlapLever': "0",
+    'GearLever': "3",
+    'McpAtArm': "0",
+    'McpFdCp': "0",
+    'EcpNdRangeCp': "2",
+    'MastWarnFo': "0",
+    'FreeMsgM': "",
+    'GroundSpeed': "0",
+    'PiBaHeAlTas': "0;0;0.0;5000000;0;0.9;0.1",
+    'TrueZfw': "600000",
+    'FuelQty': "d300292;830812;830790;300292;88295;88295;1142282;221102;214951;404491;587;",
+    'MemRcpL': "121500;0;0;0;118000;0;0;0",
+}
+
+
+class PsxStandInException(Exception):
+    """PSX stand-in exception.
+
+    For now, no special handling, this class just exists to make
+    pylint happy. :)
+    """
+
+
+class PsxClientSession():  # pylint: disable=too-few-public-methods
+    """One connected client."""
+
+    def __init__(self, client_id, writer, logger):
+        """Initialize the session."""
+        self.client_id = client_id
+        self.writer = writer
+        self.logger = logger
+        # Demand variables this client has asked for
+        self.demanded = set()
+
+    def send_lines(self, lines):
+        """Send a list of lines to the client.
+
+        Lines are sent on to all clients as they come in, without
+        waiting for slow clients. A client that falls more than
+        MAX_CLIENT_BUFFER behind is disconnected.
+        """
+        if not lines or self.writer.is_closing():
+            return
+        self.writer.write(("\n".join(lines) + "\n").encode())
+        if self.writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+            self.logger.warning("Client %d is not reading, disconnecting", self.client_id)
+            # Not close(), that would wait to send everything in the buffer
+            self.writer.transport.abort()
+
+
+class PsxStandIn():  # pylint: disable=too-many-instance-attributes
+    """A minimal PSX main server."""
+
+    def __init__(self, variables=None, demand=None, lexicon=True, logger=None):
+        """Initialize the server.
+
+        variables is added to/overrides DEFAULT_VARIABLES, demand is
+        a set of variables only sent to clients that demand them. If
+        lexicon is True, clients get a lexicon and updates use Q codes,
+        else variable names are used throughout.
+        """
+        self.logger = logger if logger is not None else logging.getLogger("psx_standin")
+        self.variables = dict(DEFAULT_VARIABLES)
+        self.variables.update(variables or {})
+        self.demand = set(demand or [])
+        self.lexicon = lexicon
+        self.version = PSX_VERSION
+        # name -> Q code and back
+        self.codes = {}
+        self.names = {}
+        for name in self.variables:
+            self.add_code(name)
+        self.sessions = {}
+        self.next_client_id = 1
+        self.start = time.monotonic_ns()
+        # Every write received: (ns since start, client id, variable, value)
+        self.writes = []
+        self.keep_writes = True
+        self.write_count = 0
+        self.write_log = None
+        self.server = None
+
+    def add_code(self, name):
+        """Give a variable a Q code, returns the lexicon line for it."""
+        index = len(self.codes)
+        self.codes[name] = f"Qs{index}"
+        self.names[f"Qs{index}"] = name
+        return f"Ls{index}(E)={name}"
+
+    def wire_key(self, name):
+        """Get the key we use on the wire for a variable."""
+        return self.codes[name] if self.lexicon else name
+
+    def variable_lines(self, session, names):
+        """Get key=value lines for the variables the session should see."""
+        return [f"{self.wire_key(name)}={self.variables[name]}" for name in names
+                if name not in self.demand or name in session.demanded]
+
+    def greeting_lines(self, session):
+        """Get everything we send to a newly connected client."""
+        lines = [f"id={session.client_id}", f"version={self.version}"]
+        if self.lexicon:
+            lines += [f"L{code[1:]}(E)={name}" for name, code in self.codes.items()]
+        lines.append("load1")
+        lines += self.variable_lines(session, self.variables)
+        lines += ["load2", "load3"]
+        return lines
+
+    def set_variable(self, name, value, source=None):
+        """Set a variable and send it to all clients except source."""
+        lines = []
+        if name not in self.variables and name not in self.codes:
+            lexicon_line = self.add_code(name)
+            if self.lexicon:
+                lines.append(lexicon_line)
+        self.variables[name] = value
+        lines.append(f"{self.wire_key(name)}={value}")
+        for session in self.sessions.values():
+            if session is source:
+                continue
+            if name in self.demand and name not in session.demanded:
+                continue
+            session.send_lines(lines)
+
+    def log_write(self, session, name, value):
+        """Log a write received from a client."""
+        t_ns = time.monotonic_ns() - self.start
+        self.write_count += 1
+        if self.keep_writes:
+            self.writes.append((t_ns, session.client_id, name, value))
+        if self.write_log is not None:
+            self.write_log.write(f"{t_ns} {session.client_id} {name}={value}\n")
+        self.logger.debug("Client %d wrote %s=%s", session.client_id, name, value)
+
+    def handle_line(self, session, line):
+        """Handle one line from a client. Returns False if the client is done."""
+        key, sep, value = line.partition('=')
+        if not sep:
+            if key in ["bang", "again"]:
+                session.send_lines(self.variable_lines(session, self.variables))
+            elif key == "exit":
+                return False
+            elif key == "pleaseBeSoKindAndQuit":
+                self.logger.info("Client %d asked us to quit, ignoring", session.client_id)
+            elif key:
+                self.logger.debug("Client %d sent unknown command %s", session.client_id, key)
+            return True
+        if key == "demand":
+            name = self.names.get(value, value)
+            session.demanded.add(name)
+            if name in self.variables:
+                session.send_lines([f"{self.wire_key(name)}={self.variables[name]}"])
+            return True
+        name = self.names.get(key, key)
+        self.log_write(session, name, value)
+        self.set_variable(name, value, source=session)
+        return True
+
+    async def handle_client(self, reader, writer):
+        """Talk to one client until it goes away."""
+        session = PsxClientSession(self.next_client_id, writer, self.logger)
+        self.next_client_id += 1
+        self.sessions[session.client_id] = session
+        self.logger.info("Client %d connected from %s", session.client_id,
+                         writer.get_extra_info('peername'))
+        session.send_lines(self.greeting_lines(session))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not self.handle_line(session, line.decode().strip()):
+                    break
+                if writer.transport.get_write_buffer_size() > 65536:
+                    await writer.drain()
+        except ConnectionError as exc:
+            self.logger.info("Client %d connection error: %s", session.client_id, exc)
+        finally:
+            del self.sessions[session.client_id]
+            self.logger.info("Client %d disconnected", session.client_id)
+            writer.close()
+
+    async def evolve(self, function, tick_hz):
+        """Change variables over time using function(t, variables)."""
+        while True:
+            await asyncio.sleep(1.0 / tick_hz)
+            t = (time.monotonic_ns() - self.start) / 1e9
+            for name, value in (function(t, self.variables) or {}).items():
+                self.set_variable(name, str(value))
+
+    async def start_server(self, host="127.0.0.1", port=PSX_PORT):
+        """Start listening for clients."""
+        self.server = await asyncio.start_server(self.handle_client, host, port)
+        self.logger.info("PSX stand-in listening on %s:%d", host, port)
+        return self.server
+
+
+def load_module_from_file(module_name, path):
+    """Load scenario file."""
+    loader = importlib.machinery.SourceFileLoader(module_name, path)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def handle_args():
+    """Handle command line arguments."""
+    parser = argparse.ArgumentParser(
+        prog='psx_standin',
+        description='Local stand-in for a PSX main server')
+    parser.add_argument('--host', action='store', default="127.0.0.1")
+    parser.add_argument('--port', action='store', default=PSX_PORT, type=int)
+    parser.add_argument('--scenario', action='store', metavar='FILE',
+                        help='Python file with VARIABLES, DEMAND and/or evolve()')
+    parser.add_argument('--tick-hz', action='store', default=10.0, type=float,
+                        help='how often the scenario evolve() is called')
+    parser.add_argument('--write-log', action='store', metavar='FILE',
+                        help='log all writes from clients to FILE')
+    parser.add_argument('--no-lexicon', action='store_true',
+                        help='use variable names instead of Q codes on the wire')
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--quiet', action='store_true')
+    return parser.parse_args()
+
+
+async def main():
+    """Start the stand-in server."""
+    args = handle_args()
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO,
+                        datefmt="%H:%M:%S")
+    logger = logging.getLogger("psx_standin")
+    if args.quiet:
+        logger.setLevel(logging.CRITICAL)
+    elif args.debug:
+        logger.setLevel(logging.DEBUG)
+    scenario = None
+    if args.scenario:
+        try:
+            scenario = load_module_from_file("scenario", args.scenario)
+        except IOError as inst:
+            raise PsxStandInException(
+                f"Failed to open scenario file {args.scenario}: {inst}") from inst
+    standin = PsxStandIn(
+        variables=getattr(scenario, 'VARIABLES', None),
+        demand=getattr(scenario, 'DEMAND', None),
+        lexicon=not args.no_lexicon,
+        logger=logger,
+    )
+    # The write log file is enough, don't keep all writes in memory too
+    standin.keep_writes = False
+    if args.write_log:
+        # pylint: disable-next=consider-using-with
+        standin.write_log = open(args.write_log, 'w', encoding='utf-8', buffering=65536)
+    server = await standin.start_server(args.host, args.port)
+    tasks = [server.serve_forever()]
+    if hasattr(scenario, 'evolve'):
+        tasks.append(standin.evolve(scenario.evolve, args.tick_hz))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if standin.write_log is not None:
+            standin.write_log.close()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt as exc:
+        raise SystemExit("Stopped by keyboard interrupt (Ctrl-C)") from exc
@@ -57,6 +57,7 @@ Requirements:
 import asyncio
 import SimConnect  # pylint: disable=import-error
 from psx import Client  # pylint: disable=import-error
+from psx_codec import PsxRecord
 
 # Keep track of the last seen VHF L and VHF R active frequencies
 global PSX_RCP_VHF_L_ACTIVE  # pylint: disable=global-at-module-level
@@ -86,9 +87,9 @@ def psx_rcp_change(_, value):
     """When PSXVHF L or R active frequency changes, update MSFS."""
     global PSX_RCP_VHF_L_ACTIVE  # pylint: disable=global-statement
     global PSX_RCP_VHF_R_ACTIVE  # pylint: disable=global-statement
-    fields = value.split(';')
-    vhf_l_active = fields[0]
-    vhf_r_active = fields[4]
+    rcp = PsxRecord("MemRcpL", value)
+    vhf_l_active = rcp['vhf l active']
+    vhf_r_active = rcp['vhf r active']
     if vhf_l_active != PSX_RCP_VHF_L_ACTIVE:
         print(f"PSX VHF L active frequency changed, updating MSFS COM 1 to {vhf_l_active}")
         PSX_RCP_VHF_L_ACTIVE = vhf_l_active
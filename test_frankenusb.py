@@ -0,0 +1,69 @@
+"""Tests for frankenusb, run with python -m unittest."""
+import asyncio
+import unittest
+import pygame  # pylint: disable=import-error
+from frankenusb import FrankenUsb, FILTER_SETTLE_INTERVAL
+from frankenusb_replay import ReplayJoystick
+
+TEST_PEDALS = 'TEST PEDALS'
+TEST_CONFIG = {
+    TEST_PEDALS: {
+        'axis motion': {
+            # Toe brake
+            0: {'axis type': 'NORMAL', 'psx variable': 'Brakes', 'indexes': [0],
+                'psx min': 0, 'psx max': 1000,
+                'filters': [{'filter type': 'EMA', 'alpha': 0.5}]},
+        },
+    },
+}
+
+
+def axis_event(value):
+    """Make a pygame axis event for the toe brake."""
+    return pygame.event.Event(pygame.JOYAXISMOTION,  # pylint: disable=no-member
+                              instance_id=0, axis=0, value=value)
+
+
+class FilterSettleTest(unittest.IsolatedAsyncioTestCase):
+    """Filtered axes end up where the axis stopped."""
+
+    async def asyncSetUp(self):
+        """Set up frankenusb with one filtered axis, without PSX."""
+        self.franken = FrankenUsb()  # pylint: disable=attribute-defined-outside-init
+        self.franken._handle_args(['--quiet'])  # pylint: disable=protected-access
+        self.franken.config = TEST_CONFIG
+        self.franken.compile_dispatch()
+        self.franken.add_joystick(ReplayJoystick(0, TEST_PEDALS))
+
+    async def handle_queued_events(self):
+        """Handle axis events, including settle events, until there are no more."""
+        while True:
+            while not self.franken.axis_event_queue.empty():
+                await self.franken.handle_axis_motion(self.franken.axis_event_queue.get_nowait())
+            if not self.franken.filter_settle_handles:
+                return
+            await asyncio.sleep(FILTER_SETTLE_INTERVAL)
+
+    def last_sent_value(self):
+        """Get the last value queued for PSX."""
+        value = None
+        while not self.franken.psx_axis_queue.empty():
+            value = self.franken.psx_axis_queue.get_nowait()['value']
+        return value
+
+    async def test_settle_after_newer_event(self):
+        """A settle event queued behind newer events does not go back to its old value."""
+        await self.franken.handle_axis_motion(axis_event(0.0))
+        # The filter lags behind, so a settle event is scheduled for -1.0
+        await self.franken.handle_axis_motion(axis_event(-1.0))
+        self.franken.axis_event_queue.put_nowait(axis_event(0.0))
+        self.franken.axis_event_queue.put_nowait(axis_event(1.0))
+        # The settle event for -1.0 is queued behind 0.0 and 1.0
+        await asyncio.sleep(FILTER_SETTLE_INTERVAL * 2)
+        await self.handle_queued_events()
+        self.assertEqual(self.franken.axis_cache[0][0], 1.0)
+        self.assertEqual(self.last_sent_value(), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()